@@ -1,22 +1,45 @@
-import os, re, asyncio
+import os, asyncio, platform
+from aiohttp import web
 from aiogram import Bot, Dispatcher, Router, F
 from aiogram.client.default import DefaultBotProperties
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.telegram import TelegramAPIServer
 from aiogram.enums import ParseMode
-from aiogram.types import Message, CallbackQuery, InlineKeyboardButton
+from aiogram.exceptions import TelegramBadRequest, TelegramForbiddenError
+from aiogram.types import Message, CallbackQuery, ChatMemberUpdated, InlineKeyboardButton
 from aiogram.utils.keyboard import InlineKeyboardBuilder
+from cache import TTLCache, SingleFlight
+from matcher import UsernameMatcher
+from outbound import OutboundScheduler, TelegramMetrics, priority, HIGH, LOW
+from webhook import run_webhook, consume_process_queue, on_stop_signal
+import state
+import leaderboard
+import metrics
+from votebuffer import VoteBuffer
+from state import ALLOWED_CHAT_IDS, ADMIN_IDS, BANNED_IDS, CHAT_SETTINGS, DEFAULT_CHAT_SETTINGS
 
 # **********************************************
 # ** 关键修复：将错误的单行导入拆分成两行 **
 from database import *
-from datetime import datetime, timedelta 
+from datetime import datetime, timedelta, timezone
 # **********************************************
 
 TOKEN = os.environ.get('BOT_TOKEN')
+# 自定义 Bot API 地址 (本地 Bot API 服务器，或压测用的 tools/fake_telegram.py)
+TELEGRAM_API_URL = os.environ.get('TELEGRAM_API_URL')
 OWNER_ID = int(os.environ.get('OWNER_ID', '0'))
+# 更新接收方式：polling (默认) 或 webhook；webhook 模式下按 chat_id 分片到多个 worker/进程
+BOT_MODE = os.environ.get('BOT_MODE', 'polling')
+WEBHOOK_WORKERS = int(os.environ.get('WEBHOOK_WORKERS', '16'))
+WEBHOOK_PROCESSES = int(os.environ.get('WEBHOOK_PROCESSES', '1'))
+# Prometheus 指标端口 (/metrics、/healthz、/readyz)，0 表示不开启；
+# Webhook 多进程时主进程占用 METRICS_PORT (所有子进程就绪后 /readyz 才返回 200)，第 i 个子进程使用 METRICS_PORT + 1 + i
+METRICS_PORT = int(os.environ.get('METRICS_PORT', '9101'))
+# 指标端口没有认证，默认只监听本机；需要被外部 Prometheus 抓取时设为 0.0.0.0 并在网络层限制来源
+METRICS_HOST = os.environ.get('METRICS_HOST', '127.0.0.1')
 
 # --- DEBUG: 临时调试代码，用于检查环境变量是否被正确加载 ---
 import sys
-import platform
 print("-" * 50)
 print(f"DEBUG: Python Version: {platform.python_version()}")
 print(f"DEBUG: OS/Platform: {sys.platform}")
@@ -27,32 +50,175 @@ print("Bot process is attempting to connect to the database...")
 print("-" * 50)
 # --- DEBUG 结束 ---
 
-bot = Bot(token=TOKEN, default=DefaultBotProperties(parse_mode=ParseMode.HTML))
+session = AiohttpSession(api=TelegramAPIServer.from_base(TELEGRAM_API_URL)) if TELEGRAM_API_URL else None
+bot = Bot(token=TOKEN, session=session, default=DefaultBotProperties(parse_mode=ParseMode.HTML))
+# 所有出站请求经过统一调度：全局约 30 次/秒，每群约 20 次/分钟，429 时按 retry_after 重试
+TG_GLOBAL_RATE = float(os.environ.get('TG_GLOBAL_RATE', '30'))
+OUTBOUND = OutboundScheduler(
+    global_rate=TG_GLOBAL_RATE,
+    chat_per_minute=float(os.environ.get('TG_CHAT_PER_MINUTE', '20')),
+)
+bot.session.middleware(OUTBOUND)
+# 在调度器之后注册：只统计真正发出的请求耗时
+bot.session.middleware(TelegramMetrics())
 dp = Dispatcher()
 router = Router()
 dp.include_router(router)
 
-PATTERN = re.compile(r"@?([\w\u4e00-\u9fa5]{2,32})")
-LAST_CARD_MSG_ID = {}
-ALLOWED_CHAT_IDS = set() 
-ADMIN_IDS = set()
+# 已知 username (来自 ratings 和见过的用户)：只有引用了它们或显式 @提及 的消息才会触发查询
+KNOWN_USERNAMES = UsernameMatcher()
+# 每个群的待渲染卡片 (只保留最新一次) 和负责渲染的后台任务
+PENDING_CARDS = {}
+CARD_WORKERS = {}
+CARD_DEBOUNCE = 0.5
+# 批量封禁：本进程正在执行的任务，以及并发数和每个 (群, 用户) 的最大尝试次数
+BAN_JOB_TASKS = {}
+BAN_CONCURRENCY = int(os.environ.get('BAN_CONCURRENCY', '8'))
+BAN_MAX_ATTEMPTS = 5
+# 执行中的任务每 30 秒续约一次 (租约 2 分钟)；各实例每分钟接手一次租约过期的未完成任务
+BAN_HEARTBEAT_INTERVAL = 30
+BAN_JOB_SWEEP_INTERVAL = 60
+# 投票写缓冲 (VOTE_WRITE_BEHIND=1)：内存中检查冷却，批量落盘，持久性约定见 votebuffer.py
+VOTE_BUFFER = VoteBuffer(
+    flush_interval=float(os.environ.get('VOTE_FLUSH_INTERVAL', '0.5')),
+    batch_size=int(os.environ.get('VOTE_BATCH_SIZE', '500')),
+) if os.environ.get('VOTE_WRITE_BEHIND') == '1' else None
+# 投票流水分区维护 (建新分区、删过期分区、清理冷却表) 的间隔
+LEDGER_MAINTENANCE_INTERVAL = 6 * 3600
+# startup 完成后置位，/readyz 据此返回 200
+READY = asyncio.Event()
+# 多实例时用于区分任务执行者
+INSTANCE_ID = f"{platform.node()}-{os.getpid()}"
+# ALLOWED_CHAT_IDS / ADMIN_IDS / BANNED_IDS / CHAT_SETTINGS 来自 state 模块，由 NOTIFY 在各实例间同步
+
+# username -> user_id 解析缓存：命中时只是一次字典查找，不再调用 get_chat
+USERNAME_CACHE = TTLCache(maxsize=50000, ttl=6 * 3600)
+# 解析失败的 username 短时间内不再重试，避免反复消耗 Telegram 限额
+USERNAME_MISSES = TTLCache(maxsize=20000, ttl=600)
+USERNAME_LOOKUPS = SingleFlight()
+# (chat_id, user_id) -> ChatMember：投票门槛检查用，由 chat_member 更新保持新鲜
+MEMBER_CACHE = TTLCache(maxsize=100000, ttl=600)
+# 未加入的用户可能随时加入，缓存时间短一些 (收到 chat_member 更新时会立即覆盖)
+NON_MEMBER_TTL = 60
+MEMBER_LOOKUPS = SingleFlight()
+# 强制关注频道的邀请链接，按频道缓存
+INVITE_LINKS = TTLCache(maxsize=1000, ttl=3600)
+# 后台任务需要保留引用，否则可能在完成前被回收
+BACKGROUND_TASKS = set()
 
 # --- 辅助函数 (省略，与之前一致) ---
+def spawn(coro):
+    task = asyncio.create_task(coro)
+    BACKGROUND_TASKS.add(task)
+    task.add_done_callback(task_done)
+    return task
+
+def task_done(task):
+    BACKGROUND_TASKS.discard(task)
+    if not task.cancelled() and task.exception():
+        print(f"Background Task Error: {task.exception()}")
+
 async def get_user_id_by_username(username: str):
-    try:
-        user_obj = await bot.get_chat(username)
-        return user_obj.id
-    except: 
+    username = username.lower()
+    user_id = USERNAME_CACHE.get(username)
+    if user_id:
+        return user_id
+    if username in USERNAME_MISSES:
         return None
+    # 同一个 username 的并发查询合并为一次
+    return await USERNAME_LOOKUPS.do(username, lambda: resolve_username(username))
+
+async def resolve_username(username: str):
+    """依次查询 usernames 表和 Telegram，并写入正/负缓存"""
+    user_id = None
+    try:
+        user_id = await lookup_username(username)
+    except Exception as e:
+        print(f"Username Lookup Error: {e}")
+
+    if not user_id:
+        try:
+            user_obj = await bot.get_chat(username)
+            user_id = user_obj.id
+            spawn(save_username(user_id, username))
+        except:
+            user_id = None
+
+    if user_id:
+        USERNAME_CACHE.set(username, user_id)
+        KNOWN_USERNAMES.add(username)
+    else:
+        USERNAME_MISSES.set(username, True)
+    return user_id
+
+async def get_member(chat_id: int, user_id: int):
+    member = MEMBER_CACHE.get((chat_id, user_id))
+    if member:
+        return member
+    return await MEMBER_LOOKUPS.do((chat_id, user_id), lambda: fetch_member(chat_id, user_id))
+
+async def fetch_member(chat_id: int, user_id: int):
+    member = await bot.get_chat_member(chat_id, user_id)
+    cache_member(chat_id, member)
+    return member
+
+def cache_member(chat_id: int, member):
+    joined = member.status in ['member', 'administrator', 'creator', 'restricted']
+    MEMBER_CACHE.set((chat_id, member.user.id), member, None if joined else NON_MEMBER_TTL)
+
+async def get_invite_link(channel_id: int):
+    invite_link = INVITE_LINKS.get(channel_id)
+    if not invite_link:
+        channel = await bot.get_chat(channel_id)
+        invite_link = channel.invite_link or f"https://t.me/{channel.username or channel_id}"
+        INVITE_LINKS.set(channel_id, invite_link)
+    return invite_link
+
+def remember_user(user):
+    """记录 Bot 见过的用户；只有映射发生变化时才写库"""
+    if not user or not user.username or user.is_bot:
+        return
+    username = user.username.lower()
+    USERNAME_MISSES.pop(username)
+    KNOWN_USERNAMES.add(username)
+    if USERNAME_CACHE.get(username) == user.id:
+        return
+    USERNAME_CACHE.set(username, user.id)
+    spawn(save_username(user.id, username))
         
-async def delete_old(chat_id: int):
-    if chat_id in LAST_CARD_MSG_ID:
-        try: await bot.delete_message(chat_id, LAST_CARD_MSG_ID[chat_id])
-        except: pass
-        del LAST_CARD_MSG_ID[chat_id]
-
-async def send_card(chat_id: int, username: str, user_id: int, r: int, b: int, net: int):
-    await delete_old(chat_id)
+async def delete_card(chat_id: int, message_id: int):
+    try: await bot.delete_message(chat_id, message_id)
+    except Exception as e: print(f"Delete Card Error in {chat_id}: {e}")
+
+async def send_card(chat_id: int, username: str, user_id: int, r: int, b: int, net: int, local_r: int, local_b: int,
+                    local_score: float = None, card_msg_id: int = None):
+    """提交卡片更新。每个群由一个后台任务串行渲染，短时间内的多次更新只渲染最新状态。
+    local_r / local_b: 本群内的推荐和拉黑数，与全局分数并列显示。
+    local_score: 本群的时间衰减分，群组未开启衰减时为 None。
+    card_msg_id: 投票时被点击的卡片，如果它仍是当前卡片则原地编辑，否则发送新卡片。"""
+    pending = PENDING_CARDS.get(chat_id)
+    # 合并期间只要有一次请求需要新卡片 (查询)，最终就发送新卡片
+    resend = card_msg_id is None or (pending is not None and pending[-1])
+    PENDING_CARDS[chat_id] = (username, user_id, r, b, net, local_r, local_b, local_score, card_msg_id, resend)
+    if chat_id not in CARD_WORKERS:
+        CARD_WORKERS[chat_id] = spawn(card_worker(chat_id))
+
+async def card_worker(chat_id: int):
+    try:
+        while chat_id in PENDING_CARDS:
+            await asyncio.sleep(CARD_DEBOUNCE)
+            card = PENDING_CARDS.pop(chat_id)
+            try:
+                # 卡片刷新优先级最低，限流时让位给回调应答和封禁
+                with priority(LOW):
+                    await render_card(chat_id, *card)
+            except Exception as e:
+                print(f"Render Card Error in {chat_id}: {e}")
+    finally:
+        CARD_WORKERS.pop(chat_id, None)
+
+async def render_card(chat_id: int, username: str, user_id: int, r: int, b: int, net: int, local_r: int, local_b: int,
+                      local_score: float, card_msg_id: int, resend: bool):
     if net >= 20: color = "Green"; medal = "🏆"
     elif net >= 5: color = "Yellow"; medal = "🥇"
     elif net >= 0: color = "White"; medal = ""
@@ -63,10 +229,180 @@ async def send_card(chat_id: int, username: str, user_id: int, r: int, b: int, n
     
     text = f"{medal}<b>{color} @{username}</b>{medal}\n"
     text += f"用户 ID: {user_id_text}\n\n"
-    text += f"推荐 <b>{r}</b>　拉黑 <b>{b}</b>\n净值 <b>{net:+d}</b>"
+    text += f"推荐 <b>{r}</b>　拉黑 <b>{b}</b>\n净值 <b>{net:+d}</b>\n\n"
+    text += f"本群 推荐 <b>{local_r}</b>　拉黑 <b>{local_b}</b>　净值 <b>{local_r - local_b:+d}</b>"
+    if local_score is not None:
+        text += f"\n近期信誉 <b>{local_score:+.1f}</b>"
     
+    current = await state.get_card_msg_id(chat_id)
+    # current 为空说明还没有登记过卡片，被点击的卡片就是最后一张
+    if not resend and card_msg_id and current in (None, card_msg_id):
+        try:
+            await bot.edit_message_text(text, chat_id=chat_id, message_id=card_msg_id, reply_markup=kb(username, user_id))
+            if current is None:
+                await state.set_card_msg_id(chat_id, card_msg_id)
+            return
+        except TelegramBadRequest as e:
+            if "message is not modified" in str(e):
+                return
+            # 卡片已被删除或无法编辑，退回到重新发送
+
     sent = await bot.send_message(chat_id, text, reply_markup=kb(username, user_id))
-    LAST_CARD_MSG_ID[chat_id] = sent.message_id
+    # 通过数据库原子交换，多实例下每张旧卡片只会被一个实例删除
+    old_id = await state.set_card_msg_id(chat_id, sent.message_id)
+    if old_id:
+        await delete_card(chat_id, old_id)
+
+def format_leaderboard(title: str, top, bottom) -> str:
+    """红榜只列净分为正的用户，黑榜只列净分为负的用户"""
+    def line(i, e):
+        name = f"@{e['username']}" if e['username'] else f"<code>{e['user_id']}</code>"
+        return f"{i}. {name}　<b>{e['net']:+d}</b> (推荐 {e['rec']} / 拉黑 {e['black']})"
+
+    text = f"<b>{title}</b>\n\n🏆 红榜\n"
+    text += "\n".join(line(i, e) for i, e in enumerate([e for e in top if e['net'] > 0], 1)) or "暂无"
+    text += "\n\n☠️ 黑榜\n"
+    text += "\n".join(line(i, e) for i, e in enumerate([e for e in bottom if e['net'] < 0], 1)) or "暂无"
+    return text
+
+# --- 用户资料 (/userinfo) ---
+USERINFO_PAGE = 10
+USERINFO_CHATS = 10
+EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+
+def format_userinfo(user_id: int, profile, chats, votes, direction: str, first_page: bool) -> str:
+    name = f"@{profile['username']}" if profile['username'] else "(无 username)"
+    text = f"👤 {name} (ID: <code>{user_id}</code>)"
+    if profile['banned']:
+        text += " 🚫 已封禁"
+    text += f"\n全局: <b>{profile['rec'] - profile['black']:+d}</b> (推荐 {profile['rec']} / 拉黑 {profile['black']})\n"
+    if chats:
+        text += "\n<b>各群</b>\n"
+        for c in chats[:USERINFO_CHATS]:
+            text += f"<code>{c['chat_id']}</code>　<b>{c['net']:+d}</b> (推荐 {c['rec']} / 拉黑 {c['black']})"
+            if c['half_life_days']:
+                text += f" 近期 {c['score']:.1f}"
+            text += "\n"
+        if len(chats) > USERINFO_CHATS:
+            text += f"... 共 {len(chats)}{'+' if len(chats) == PROFILE_CHATS_LIMIT else ''} 个群\n"
+
+    text += "\n<b>" + ("收到的投票" if direction == "received" else "投出的投票") + ("" if first_page else " (更早)") + "</b>\n"
+    for v in votes:
+        other_id = v['voter_id'] if direction == "received" else v['target_id']
+        other = f"@{v['username']}" if v['username'] else f"<code>{other_id}</code>"
+        arrow = "←" if direction == "received" else "→"
+        line = f"{v['time'].astimezone(timezone.utc):%m-%d %H:%M} {'推荐' if v['type'] == 'rec' else '拉黑'} {arrow} {other} 群 <code>{v['chat_id']}</code>"
+        link = evidence_link(v['chat_id'], v['evidence_msg_id'])
+        if link:
+            line += f' <a href="{link}">证据</a>'
+        text += line + "\n"
+    if not votes:
+        text += "暂无\n"
+    return text
+
+async def render_userinfo(user_id: int, direction: str = "received", before=None):
+    """返回 (文本, 按钮)。按钮切换收到/投出的票，以及按 (time, id) 游标翻到更早的一页"""
+    (profile, chats), votes = await asyncio.gather(
+        get_user_profile(user_id), get_user_votes(user_id, direction, USERINFO_PAGE, before))
+    text = format_userinfo(user_id, profile, chats, votes, direction, before is None)
+
+    other = "cast" if direction == "received" else "received"
+    buttons = [InlineKeyboardButton(text="投出的票" if other == "cast" else "收到的票", callback_data=f"userinfo:{user_id}:{other}")]
+    if len(votes) == USERINFO_PAGE:
+        last = votes[-1]
+        # 游标用整数微秒，避免浮点时间戳丢失精度导致翻页重复或漏行
+        micros = (last['time'] - EPOCH) // timedelta(microseconds=1)
+        buttons.append(InlineKeyboardButton(text="更早 »", callback_data=f"userinfo:{user_id}:{direction}:{micros}:{last['id']}"))
+    b = InlineKeyboardBuilder()
+    b.row(*buttons)
+    return text, b.as_markup()
+
+# --- 批量封禁任务 ---
+async def resolve_ban_target(name: str):
+    """纯数字视为用户 ID，否则按 username 解析"""
+    return int(name) if name.isdigit() else await get_user_id_by_username(name)
+
+def start_ban_job(job_id: int):
+    if job_id not in BAN_JOB_TASKS:
+        task = spawn(run_ban_job(job_id))
+        BAN_JOB_TASKS[job_id] = task
+        task.add_done_callback(lambda _: BAN_JOB_TASKS.pop(job_id, None))
+
+async def run_ban_job(job_id: int):
+    """分批取出待执行的 (群, 用户)，并发踢出；每批结束后汇报进度。执行期间后台定时续约执行权"""
+    if not await claim_ban_job(job_id, INSTANCE_ID):
+        return
+    heartbeat = spawn(renew_ban_job(job_id, asyncio.current_task()))
+    try:
+        sem = asyncio.Semaphore(BAN_CONCURRENCY)
+        while True:
+            tasks = await get_pending_ban_tasks(job_id)
+            if not tasks:
+                break
+            await asyncio.gather(*(ban_member(job_id, t['chat_id'], t['user_id'], t['attempts'], sem) for t in tasks))
+            await report_ban_progress(job_id)
+        await finish_ban_job(job_id)
+    finally:
+        heartbeat.cancel()
+    await report_ban_progress(job_id)
+
+async def renew_ban_job(job_id: int, job_task: asyncio.Task):
+    # 一批任务遇到重试或 429 等待时可能超过租约时长，所以按时间续约而不是每批续约一次；
+    # 租约已被其他实例接手时停止本地执行，未完成的 (群, 用户) 由新的持有者继续
+    while True:
+        await asyncio.sleep(BAN_HEARTBEAT_INTERVAL)
+        try:
+            claimed = await claim_ban_job(job_id, INSTANCE_ID)
+        except Exception as e:
+            print(f"Ban job {job_id} heartbeat error: {e}")
+            continue
+        if not claimed:
+            print(f"Ban job {job_id} lease lost, stopping")
+            job_task.cancel()
+            return
+
+async def ban_job_sweeper():
+    # 持有任务的实例退出后租约会过期，但其他实例只在重启时才会接手；定期扫描未完成的任务，
+    # start_ban_job 会跳过本实例已在执行的任务，claim_ban_job 会跳过其他实例租约未过期的任务
+    while True:
+        try:
+            for job_id in await get_unfinished_ban_jobs():
+                start_ban_job(job_id)
+        except Exception as e:
+            print(f"Ban job sweep error: {e}")
+        await asyncio.sleep(BAN_JOB_SWEEP_INTERVAL)
+
+async def ban_member(job_id: int, chat_id: int, user_id: int, attempts: int, sem: asyncio.Semaphore):
+    error = None
+    while attempts < BAN_MAX_ATTEMPTS:
+        attempts += 1
+        try:
+            # 批量踢出用低优先级：BanChatMember 默认是 HIGH，大任务会一直占满全局令牌，
+            # 卡片、回复和用户名查询要等整个任务结束才能发出；群内即时封禁仍用 HIGH
+            async with sem:
+                with priority(LOW):
+                    await bot.ban_chat_member(chat_id, user_id)
+            await update_ban_task(job_id, chat_id, user_id, 'done', attempts)
+            return
+        except (TelegramBadRequest, TelegramForbiddenError) as e:
+            # 无权限、不在群内等永久性错误，重试也没用
+            error = str(e)
+            break
+        except Exception as e:
+            error = str(e)
+            await asyncio.sleep(min(2 ** attempts, 60))
+    await update_ban_task(job_id, chat_id, user_id, 'failed', attempts, error)
+
+async def report_ban_progress(job_id: int):
+    job = await get_ban_job(job_id)
+    if not job or not job['report_msg_id']:
+        return
+    icon = "✅" if job['finished_at'] else "⏳"
+    text = f"{icon} 封禁任务 #{job_id}：{job['done']}/{job['total']} 已完成，{job['failed']} 失败"
+    try:
+        await bot.edit_message_text(text, chat_id=job['report_chat_id'], message_id=job['report_msg_id'])
+    except Exception as e:
+        print(f"Ban Progress Report Error: {e}")
 
 def kb(username: str, user_id: int):
     b = InlineKeyboardBuilder()
@@ -76,12 +412,8 @@ def kb(username: str, user_id: int):
     return b.as_markup()
 
 async def load_configs():
-    global ALLOWED_CHAT_IDS, ADMIN_IDS
     try:
-        chats = await get_allowed_chats()
-        ALLOWED_CHAT_IDS = {c['chat_id'] for c in chats}
-        
-        ADMIN_IDS = await load_admins()
+        await state.load()
         if OWNER_ID and OWNER_ID not in ADMIN_IDS:
             ADMIN_IDS.add(OWNER_ID)
             await save_admin(OWNER_ID)
@@ -89,17 +421,52 @@ async def load_configs():
     except Exception as e:
         print(f"Error loading configs: {e}")
 
+@dp.message.outer_middleware()
+async def observe_message_users(handler, event: Message, data):
+    remember_user(event.from_user)
+    if event.reply_to_message:
+        remember_user(event.reply_to_message.from_user)
+    return await handler(event, data)
+
+@dp.callback_query.outer_middleware()
+async def observe_callback_users(handler, event: CallbackQuery, data):
+    remember_user(event.from_user)
+    return await handler(event, data)
+
+@router.message.middleware()
+@router.callback_query.middleware()
+@router.chat_member.middleware()
+@router.my_chat_member.middleware()
+async def observe_handler_latency(handler, event, data):
+    """按处理函数统计耗时和异常 (bot_handler_seconds{handler="vote"} 等)"""
+    name = data['handler'].callback.__name__
+    try:
+        with metrics.HANDLER_SECONDS.time(name):
+            return await handler(event, data)
+    except Exception:
+        metrics.HANDLER_ERRORS.inc(name)
+        raise
+
 # === 群组消息处理 (省略，与之前一致) ===
 @router.message(F.chat.type.in_({"group", "supergroup"}))
 async def group(msg: Message):
     if msg.chat.id not in ALLOWED_CHAT_IDS: return
 
-    if msg.from_user.id and await is_banned(msg.from_user.id):
+    if msg.from_user.id in BANNED_IDS:
         try:
-            await bot.ban_chat_member(msg.chat.id, msg.from_user.id)
-            await msg.delete()
+            with priority(HIGH):
+                await bot.ban_chat_member(msg.chat.id, msg.from_user.id)
+                await msg.delete()
             return
-        except: pass
+        except Exception as e: print(f"Ban Enforce Error in {msg.chat.id}: {e}")
+
+    # /top: 本群排行；/top global: 全局排行
+    parts = (msg.text or "").split()
+    if parts and parts[0].split('@')[0] == "/top":
+        scope = None if parts[1:2] == ["global"] else msg.chat.id
+        top, bottom = await leaderboard.get_leaderboard(scope)
+        await msg.reply(format_leaderboard("全局排行" if scope is None else "本群排行", top, bottom))
+        return
 
     target_username = None
     if msg.reply_to_message and msg.reply_to_message.from_user:
@@ -107,20 +474,31 @@ async def group(msg: Message):
             target_username = msg.reply_to_message.from_user.username.lower()
     
     if not target_username:
-        for raw in PATTERN.findall(msg.text or ""):
-            username = raw.lstrip("@").lower()
-            if len(username) >= 3 and not username.isdigit():
-                target_username = username
-                break
+        target_username = KNOWN_USERNAMES.find(msg.text or "")
     
     if not target_username:
         return
 
     username = target_username
     user_id = await get_user_id_by_username(username)
-    r, b, _ = await get_stats(user_id)
+    half_life = CHAT_SETTINGS.get(msg.chat.id, DEFAULT_CHAT_SETTINGS)['decay_half_life_days']
+    r, b, local_r, local_b, local_score = await get_card_stats(msg.chat.id, user_id, half_life)
     
-    await send_card(msg.chat.id, username, user_id, r, b, r-b)
+    await send_card(msg.chat.id, username, user_id, r, b, r-b, local_r, local_b, local_score if half_life else None)
+
+# 须在 vote 之前注册：vote 接收其余所有回调
+@router.callback_query(F.data.startswith("userinfo:"))
+async def userinfo_page(cb: CallbackQuery):
+    if cb.from_user.id not in ADMIN_IDS:
+        await cb.answer("无权限", show_alert=True); return
+    parts = cb.data.split(":")
+    user_id, direction = int(parts[1]), parts[2]
+    before = None
+    if len(parts) == 5:
+        before = (EPOCH + timedelta(microseconds=int(parts[3])), int(parts[4]))
+    text, markup = await render_userinfo(user_id, direction, before)
+    await cb.message.edit_text(text, reply_markup=markup, disable_web_page_preview=True)
+    await cb.answer()
 
 @router.callback_query()
 async def vote(cb: CallbackQuery):
@@ -141,16 +519,15 @@ async def vote(cb: CallbackQuery):
         
     evidence_msg_id = cb.message.reply_to_message.message_id
     
-    settings = await get_chat_settings(chat_id)
+    settings = CHAT_SETTINGS.get(chat_id, DEFAULT_CHAT_SETTINGS)
     
     # 强制关注/加入检查
     if settings['force_channel_id'] != 0:
         try:
             channel_id = settings['force_channel_id']
-            member = await bot.get_chat_member(channel_id, voter_id)
+            member = await get_member(channel_id, voter_id)
             if member.status not in ['member', 'administrator', 'creator']:
-                channel = await bot.get_chat(channel_id)
-                invite_link = channel.invite_link or f"https://t.me/{channel.username or channel_id}"
+                invite_link = await get_invite_link(channel_id)
                 await cb.answer(f"⚠️ 使用机器人需先加入频道/群组：{invite_link}", show_alert=True)
                 return
         except Exception as e: 
@@ -160,7 +537,7 @@ async def vote(cb: CallbackQuery):
     min_days = settings['min_join_days']
     if min_days > 0:
         try:
-            member = await bot.get_chat_member(chat_id, voter_id)
+            member = await get_member(chat_id, voter_id)
             
             if member.status in ['member', 'restricted']: 
                 join_date = member.joined_at.replace(tzinfo=None) if member.joined_at else datetime.min
@@ -175,19 +552,31 @@ async def vote(cb: CallbackQuery):
             await cb.answer("入群时间检查失败，请稍后重试。", show_alert=True)
             return
 
-    # 检查 24 小时投票限制
-    if not await can_vote(chat_id, voter_id, user_id, typ):
+    # 原子投票：24 小时限制检查、记录投票和计数在同一条语句内完成
+    record = VOTE_BUFFER.add if VOTE_BUFFER else add_vote
+    totals = await record(chat_id, voter_id, user_id, typ, username, evidence_msg_id, settings['decay_half_life_days'])
+    if totals is None:
         await cb.answer("24h内只能投一次", show_alert=True); return
     
-    # 异步添加投票
-    await add_vote(chat_id, voter_id, user_id, typ, username, evidence_msg_id)
-    
     # 更新卡片
-    r, b, _ = await get_stats(user_id)
-    await delete_old(cb.message.chat.id)
-    await send_card(cb.message.chat.id, username, user_id, r, b, r-b)
+    r, b, local_r, local_b, local_score = totals
+    leaderboard.record_vote(chat_id, user_id, username, r, b, local_r, local_b)
+    await send_card(cb.message.chat.id, username, user_id, r, b, r-b, local_r, local_b,
+                    local_score if settings['decay_half_life_days'] else None, card_msg_id=cb.message.message_id)
     await cb.answer("投票成功，证据已记录")
 
+# === 成员变动 (保持成员缓存新鲜) ===
+@router.chat_member()
+async def chat_member_changed(update: ChatMemberUpdated):
+    cache_member(update.chat.id, update.new_chat_member)
+
+@router.my_chat_member()
+async def bot_member_changed(update: ChatMemberUpdated):
+    # Bot 自身权限变化后 (如被移出频道或取消管理员)，之前缓存的成员状态不再可信
+    chat_id = update.chat.id
+    MEMBER_CACHE.discard_where(lambda key: key[0] == chat_id)
+    INVITE_LINKS.pop(chat_id)
+
 # === 私聊管理员面板 (省略，与之前一致) ===
 @router.message(F.chat.type == "private")
 async def private_handler(msg: Message):
@@ -204,15 +593,27 @@ async def private_handler(msg: Message):
             chat_id, days = int(chat_id), int(days)
             if days < 0: raise ValueError
             
-            async with db_pool.acquire() as conn:
-                await conn.execute("""
-                    INSERT INTO chat_settings (chat_id, min_join_days) VALUES ($1, $2)
-                    ON CONFLICT (chat_id) DO UPDATE SET min_join_days = $2
-                """, chat_id, days)
+            await set_min_join_days(chat_id, days)
+            CHAT_SETTINGS.setdefault(chat_id, dict(DEFAULT_CHAT_SETTINGS))['min_join_days'] = days
                 
             await msg.reply(f"✅ 群组 {chat_id} 投票门槛设置为：入群 {days} 天后允许投票。")
         except: await msg.reply("用法: /setjoindays [群ID] [天数] (例如: /setjoindays -100xxx 7)")
 
+    elif text.startswith("/setdecay "):
+        try:
+            _, chat_id, days = text.split()
+            chat_id, days = int(chat_id), int(days)
+            if days < 0: raise ValueError
+
+            await set_decay_half_life(chat_id, days)
+            CHAT_SETTINGS.setdefault(chat_id, dict(DEFAULT_CHAT_SETTINGS))['decay_half_life_days'] = days
+
+            if days:
+                await msg.reply(f"✅ 群组 {chat_id} 近期信誉半衰期设置为 {days} 天。")
+            else:
+                await msg.reply(f"✅ 群组 {chat_id} 已关闭近期信誉 (时间衰减)。")
+        except: await msg.reply("用法: /setdecay [群ID] [半衰期天数] (0 为关闭，例如: /setdecay -100xxx 30)")
+
     elif text.startswith("/setforcechannel "):
         try:
             parts = text.split()
@@ -235,11 +636,8 @@ async def private_handler(msg: Message):
                  await msg.reply("❌ 无法解析频道/群组 ID 或链接无效。")
                  return
             
-            async with db_pool.acquire() as conn:
-                await conn.execute("""
-                    INSERT INTO chat_settings (chat_id, force_channel_id) VALUES ($1, $2)
-                    ON CONFLICT (chat_id) DO UPDATE SET force_channel_id = $2
-                """, chat_id, channel_id)
+            await set_force_channel(chat_id, channel_id)
+            CHAT_SETTINGS.setdefault(chat_id, dict(DEFAULT_CHAT_SETTINGS))['force_channel_id'] = channel_id
                 
             await msg.reply(f"✅ 群组 {chat_id} 强制关注设置为：频道/群 {channel_id} (<code>{channel_link}</code>)。")
         except: await msg.reply("用法: /setforcechannel [群ID] [频道/群ID/@链接] (例如: /setforcechannel -100xxx @channelname)")
@@ -248,7 +646,7 @@ async def private_handler(msg: Message):
         try:
             gid = int(text.split()[1])
             await save_group(gid)
-            await load_configs() 
+            ALLOWED_CHAT_IDS.add(gid)
             await msg.reply(f"✅ 已授权: {gid}")
         except: await msg.reply("用法: /add -100xxx")
     
@@ -256,25 +654,30 @@ async def private_handler(msg: Message):
         try:
             gid = int(text.split()[1])
             await del_group(gid)
-            await load_configs() 
+            ALLOWED_CHAT_IDS.discard(gid)
             await msg.reply(f"🗑️ 已删除: {gid}")
         except: await msg.reply("用法: /del -100xxx")
 
     elif text.startswith("/banuser "):
         try:
-            u = text.split(maxsplit=1)[1].lstrip("@").lower()
-            uid = await get_user_id_by_username(u)
-            if not uid: await msg.reply("❌ 找不到用户ID"); return
+            # 支持一次拉黑多个用户：/banuser @a @b 123456
+            names = [t.lstrip("@").lower() for t in text.split()[1:]]
+            if not names: raise ValueError
+            uids = await asyncio.gather(*(resolve_ban_target(n) for n in names))
+            users = [(uid, None if n.isdigit() else n) for n, uid in zip(names, uids) if uid]
+            missing = [n for n, uid in zip(names, uids) if not uid]
+            if not users: await msg.reply("❌ 找不到用户ID"); return
 
-            await ban_user(uid, u)
-            
-            count = 0
-            for gid in ALLOWED_CHAT_IDS:
-                try: await bot.ban_chat_member(gid, uid); count += 1
-                except: pass
+            job_id, total = await create_ban_job(users)
+            BANNED_IDS.update(uid for uid, _ in users)
             
-            await msg.reply(f"🚫 已拉黑 @{u} (ID: {uid}) (在 {count} 个群执行踢出)")
-        except: await msg.reply("用法: /banuser @name")
+            text = f"🚫 已拉黑 {len(users)} 个用户，正在 {total} 个 (群, 用户) 上执行踢出 (任务 #{job_id})"
+            if missing:
+                text += f"\n❌ 找不到用户ID: {', '.join('@' + n for n in missing)}"
+            report = await msg.reply(text)
+            await set_ban_job_report(job_id, msg.chat.id, report.message_id)
+            start_ban_job(job_id)
+        except: await msg.reply("用法: /banuser @name [@name2 用户ID ...]")
     
     elif text.startswith("/clearuser "):
         try:
@@ -282,10 +685,24 @@ async def private_handler(msg: Message):
             uid = await get_user_id_by_username(u)
             if not uid: await msg.reply("❌ 找不到用户ID"); return
 
+            if VOTE_BUFFER:
+                await VOTE_BUFFER.flush()  # 先写入缓冲中的投票，避免清理后又被写回
             await clear_user_data(uid)
+            if VOTE_BUFFER:
+                VOTE_BUFFER.forget(uid)
             await msg.reply(f"🧹 已清理 @{u} (ID: {uid}) 所有记录")
         except: await msg.reply("用法: /clearuser @name")
         
+    elif text.startswith("/userinfo "):
+        try:
+            name = text.split()[1].lstrip("@").lower()
+            uid = await resolve_ban_target(name)
+            if not uid: await msg.reply("❌ 找不到用户ID"); return
+
+            text, markup = await render_userinfo(uid)
+            await msg.reply(text, reply_markup=markup, disable_web_page_preview=True)
+        except: await msg.reply("用法: /userinfo @name 或 /userinfo 用户ID")
+
     elif text.startswith("/setwelcome "):
         new_text = text[len("/setwelcome "):].strip()
         if not new_text:
@@ -296,14 +713,100 @@ async def private_handler(msg: Message):
         await msg.reply(f"📝 欢迎词已更新！\n\n预览：\n{new_text}")
 
     elif text in ["/start", "/help"]:
-        await msg.reply("<b>管理面板:</b>\n/add /del : 授权群管理\n/banuser /clearuser : 用户操作\n/setwelcome : 修改欢迎词\n/setjoindays /setforcechannel : 设置群组门槛")
+        await msg.reply("<b>管理面板:</b>\n/add /del : 授权群管理\n/banuser /clearuser : 用户操作 (/banuser 可一次填写多个)\n/userinfo : 查看用户的分数和投票记录\n/setwelcome : 修改欢迎词\n/setjoindays /setforcechannel : 设置群组门槛\n/setdecay : 设置群组近期信誉 (时间衰减) 的半衰期")
+
+async def ledger_maintenance():
+    # 启动后立即执行一次 (在后台，不阻塞启动)，之后定期执行
+    while True:
+        try:
+            await maintain_vote_ledger()
+        except Exception as e:
+            print(f"Vote ledger maintenance error: {e}")
+        await asyncio.sleep(LEDGER_MAINTENANCE_INTERVAL)
+
+async def load_usernames():
+    # username 匹配表可能很大，在后台载入；载入完成前新出现的 username 照常加入
+    KNOWN_USERNAMES.update(await load_known_usernames())
+    print(f"Loaded {len(KNOWN_USERNAMES)} known usernames")
+
+async def healthz(request):
+    # 存活检查：进程在运行、事件循环能响应
+    return web.Response(text="ok")
+
+async def readyz(request):
+    # 就绪检查：startup 完成 (结构已迁移、监听和缓存已就绪) 后才返回 200
+    if not READY.is_set():
+        return web.Response(status=503, text="starting")
+    return web.Response(text="ready")
+
+async def startup(metrics_port: int = METRICS_PORT):
+    """初始化数据库、变更监听和本地缓存；耗时的缓存载入和维护任务放到后台"""
+    if metrics_port:
+        await metrics.serve(METRICS_HOST, metrics_port, {'/healthz': healthz, '/readyz': readyz})
+    await init_schema()
+    await state.subscribe()
+    await listen(BAN_JOBS_CHANNEL, lambda payload: start_ban_job(int(payload)))
+    on_listen_reconnect(load_configs)
+    await start_listening()
+    await load_configs() 
+    spawn(load_usernames())
+    # 继续执行上次未完成的封禁任务，之后定期接手其他实例遗留的任务
+    spawn(ban_job_sweeper())
+    spawn(ledger_maintenance())
+    if VOTE_BUFFER:
+        await VOTE_BUFFER.start()
+    READY.set()
+
+async def shutdown():
+    """退出前把写缓冲中的投票全部落盘"""
+    if VOTE_BUFFER:
+        await VOTE_BUFFER.close()
+
+async def run_shard_process(queue, stride: int, index: int, ready):
+    # 子进程单独收到信号时 (如 Ctrl-C 发给整个进程组)：往自己的队列放入结束标记，
+    # 处理完已收到的更新后正常退出；主进程 stop() 放入的结束标记效果相同
+    on_stop_signal(queue.put_nowait, None)
+    # 每个子进程各自限流：全局限额按进程数平分，每群限额不变 (同一个群只会分到同一个子进程)
+    OUTBOUND.set_global_rate(TG_GLOBAL_RATE / stride)
+    await startup(METRICS_PORT + 1 + index if METRICS_PORT else 0)
+    ready.set()
+    try:
+        await consume_process_queue(queue, dp, bot, WEBHOOK_WORKERS, stride)
+    finally:
+        await shutdown()
+
+def shard_process_main(queue, stride: int, index: int, ready):
+    """Webhook 多进程模式下子进程的入口"""
+    asyncio.run(run_shard_process(queue, stride, index, ready))
+
+def announce_ready():
+    print("狼猎信誉机器人 - 异步 PostgreSQL 高级功能版本已启动") # READY_FLAG
 
 async def main():
     try:
-        await init_schema()
-        await load_configs() 
-        print("狼猎信誉机器人 - 异步 PostgreSQL 高级功能版本已启动") # READY_FLAG
-        await dp.start_polling(bot)
+        if BOT_MODE == "webhook" and WEBHOOK_PROCESSES > 1:
+            # 主进程只负责接收并转发，数据库和缓存由各子进程自行初始化；
+            # 全部子进程就绪后主进程的 /readyz 才返回 200，并打印启动标志
+            def shards_ready():
+                READY.set()
+                announce_ready()
+            if METRICS_PORT:
+                await metrics.serve(METRICS_HOST, METRICS_PORT, {'/healthz': healthz, '/readyz': readyz})
+            await run_webhook(bot, dp, WEBHOOK_WORKERS, WEBHOOK_PROCESSES, shard_process_main, shards_ready)
+            return
+
+        await startup()
+        announce_ready()
+        try:
+            if BOT_MODE == "webhook":
+                await run_webhook(bot, dp, WEBHOOK_WORKERS)
+            else:
+                # 收到 SIGTERM / SIGINT 时停止轮询，返回后执行 shutdown() 把写缓冲落盘
+                on_stop_signal(lambda: spawn(dp.stop_polling()))
+                # chat_member 更新默认不推送，需要显式订阅
+                await dp.start_polling(bot, allowed_updates=dp.resolve_used_update_types(), handle_signals=False)
+        finally:
+            await shutdown()
     except Exception as e:
         # 打印具体错误信息
         print(f"BOT FAILED TO START due to database or config error: {e}") 
@@ -311,4 +814,4 @@ async def main():
         exit(1)
 
 if __name__ == "__main__":
-    asyncio.run(main())
\ No newline at end of file
+    asyncio.run(main())
@@ -0,0 +1,63 @@
+import time
+import asyncio
+from collections import OrderedDict
+
+class TTLCache:
+    """有界 LRU 缓存，每个条目带过期时间 (单进程、单事件循环内使用，无需加锁)"""
+
+    def __init__(self, maxsize: int = 10000, ttl: float = 3600):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()
+
+    def get(self, key, default=None):
+        item = self._data.get(key)
+        if item is None:
+            return default
+        value, expires = item
+        if expires < time.monotonic():
+            del self._data[key]
+            return default
+        self._data.move_to_end(key)
+        return value
+
+    def set(self, key, value, ttl: float = None):
+        self._data[key] = (value, time.monotonic() + (self.ttl if ttl is None else ttl))
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def pop(self, key, default=None):
+        item = self._data.pop(key, None)
+        return item[0] if item else default
+
+    def clear(self):
+        self._data.clear()
+
+    def discard_where(self, predicate):
+        """删除所有 key 满足 predicate 的条目 (O(n)，只用于低频的批量失效)"""
+        for key in [k for k in self._data if predicate(k)]:
+            del self._data[key]
+
+    def __contains__(self, key):
+        return self.get(key, _MISSING) is not _MISSING
+
+    def __len__(self):
+        return len(self._data)
+
+_MISSING = object()
+
+class SingleFlight:
+    """合并同一个 key 的并发请求：同一时刻只有一个协程真正执行，其余等待同一个结果"""
+
+    def __init__(self):
+        self._inflight = {}
+
+    async def do(self, key, func):
+        task = self._inflight.get(key)
+        if task is None:
+            task = asyncio.ensure_future(func())
+            self._inflight[key] = task
+            task.add_done_callback(lambda _: self._inflight.pop(key, None))
+        # shield: 某个等待者被取消时，不影响其他等待者拿到结果
+        return await asyncio.shield(task)
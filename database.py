@@ -1,11 +1,43 @@
 import os
+import time
+import asyncio
+import inspect
 import asyncpg
-from datetime import datetime, timedelta
+import metrics
+from datetime import datetime, timedelta, timezone
 
 DATABASE_URL = os.environ.get('DATABASE_URL')
 # 全局连接池，Bot 和 Web 都使用它
 db_pool = None
 
+# LISTEN/NOTIFY 频道：写操作在同一条语句里发出通知，其他进程据此刷新本地缓存
+BANNED_CHANNEL = 'banned_users'
+CHAT_SETTINGS_CHANNEL = 'chat_settings'
+BAN_JOBS_CHANNEL = 'ban_jobs'
+ALLOWED_CHATS_CHANNEL = 'allowed_chats'
+ADMINS_CHANNEL = 'admins'
+CHAT_CARDS_CHANNEL = 'chat_cards'
+
+# 投票流水按月分区：提前创建的月数，以及保留的月数 (0 表示永久保留)
+LEDGER_MONTHS_AHEAD = 2
+VOTE_RETENTION_MONTHS = int(os.environ.get('VOTE_RETENTION_MONTHS', '0'))
+# 分区维护的咨询锁，多实例同时启动时只有一个执行
+LEDGER_LOCK_ID = 7203001
+# 批量投票落盘时按被投票人加的事务级咨询锁 (两参数形式的第一个参数)
+VOTE_LOCK_ID = 7203002
+# 连接池大小 (asyncpg 默认 10/10)；Gunicorn 多 Worker 时每个 Worker 各一个连接池
+DB_POOL_MIN_SIZE = int(os.environ.get('DB_POOL_MIN_SIZE', '10'))
+DB_POOL_MAX_SIZE = int(os.environ.get('DB_POOL_MAX_SIZE', '10'))
+
+# 连接池使用情况 (size / idle / in_use / max)，输出指标时实时读取
+POOL_CONNECTIONS = metrics.Gauge('db_pool_connections', 'asyncpg pool connections by state', ['state'],
+                                 func=lambda: db_pool.stats() if db_pool else {})
+
+# 专用的监听连接 (不占用连接池)，以及 频道 -> 回调列表
+listen_conn = None
+LISTENERS = {}
+RECONNECT_HOOKS = []
+
 async def init_db_pool():
     """初始化数据库连接池"""
     global db_pool
@@ -17,26 +49,120 @@ async def init_db_pool():
     
     try:
         # 保留 ssl='disable' 尝试解决云数据库的 SSL/TLS 连接问题
-        db_pool = await asyncpg.create_pool(DATABASE_URL, ssl='disable')
+        # 包装一层以统计获取连接的等待时间和排队数
+        db_pool = metrics.TimedPool(await asyncpg.create_pool(
+            DATABASE_URL, ssl='disable', min_size=DB_POOL_MIN_SIZE, max_size=max(DB_POOL_MIN_SIZE, DB_POOL_MAX_SIZE)))
         print("Database connection pool successfully initialized.")
     except Exception as e:
         print(f"FATAL ERROR: Could not connect to database: {e}")
         # 抛出异常，让进程中止
         raise
 
-async def init_schema():
-    """初始化数据库表结构"""
-    await init_db_pool()
+async def warm_up_pool():
+    """预热连接池：同时占用 min_size 个连接各执行一次查询，确认连接可用，
+    第一批请求不用再等建立连接"""
+    async def ping():
+        async with db_pool.acquire() as conn:
+            await conn.fetchval("SELECT 1")
+    await asyncio.gather(*(ping() for _ in range(db_pool.get_min_size())))
 
-    async with db_pool.acquire() as conn:
-        await conn.execute('''
+async def close_db_pool():
+    """关闭数据库连接池 (进程退出时调用)"""
+    global db_pool
+    if db_pool:
+        await db_pool.close()
+        db_pool = None
+
+async def listen(channel: str, callback):
+    """订阅 NOTIFY 频道，callback(payload) 可以是普通函数或协程函数"""
+    LISTENERS.setdefault(channel, []).append(callback)
+    if listen_conn and len(LISTENERS[channel]) == 1:
+        await listen_conn.add_listener(channel, dispatch_notify)
+
+def on_listen_reconnect(hook):
+    """注册监听连接重连后的回调：断线期间的通知会丢失，需要全量重新加载"""
+    RECONNECT_HOOKS.append(hook)
+
+def dispatch_notify(conn, pid, channel, payload):
+    for callback in LISTENERS.get(channel, []):
+        try:
+            result = callback(payload)
+            if inspect.isawaitable(result):
+                asyncio.ensure_future(result)
+        except Exception as e:
+            print(f"Notify Handler Error on {channel}: {e}")
+
+def listen_terminated(conn):
+    asyncio.ensure_future(reconnect_listening())
+
+async def start_listening():
+    """建立专用监听连接并订阅所有已注册的频道"""
+    global listen_conn
+    if not DATABASE_URL:
+        raise ValueError("DATABASE_URL environment variable is not set!")
+    listen_conn = await asyncpg.connect(DATABASE_URL, ssl='disable')
+    for channel in LISTENERS:
+        await listen_conn.add_listener(channel, dispatch_notify)
+    listen_conn.add_termination_listener(listen_terminated)
+
+async def reconnect_listening():
+    delay = 1
+    while True:
+        try:
+            await start_listening()
+            print("Database listener reconnected.")
+            break
+        except Exception as e:
+            print(f"Database listener reconnect failed: {e}")
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, 60)
+    for hook in RECONNECT_HOOKS:
+        try:
+            await hook()
+        except Exception as e:
+            print(f"Listener Reconnect Hook Error: {e}")
+
+async def stop_listening():
+    global listen_conn
+    if listen_conn:
+        conn, listen_conn = listen_conn, None
+        # 主动关闭时不触发重连
+        conn.remove_termination_listener(listen_terminated)
+        await conn.close()
+
+# --- 结构迁移 ---
+# 按版本号顺序执行，每个版本只执行一次 (记录在 schema_migrations 表)。
+# 新的结构变更追加到 MIGRATIONS 末尾，已发布的版本不要再修改。
+MIGRATION_LOCK_ID = 7203000
+
+async def migrate_baseline(conn):
+    """版本 1：引入迁移之前的完整结构。全部是 IF NOT EXISTS，在已有的数据库上执行也是安全的"""
+    await conn.execute('''
             CREATE TABLE IF NOT EXISTS ratings (
                 user_id BIGINT PRIMARY KEY,
                 username VARCHAR(32),
                 rec INTEGER DEFAULT 0,
                 black INTEGER DEFAULT 0
             );
+            -- 排行榜：按净分的表达式索引，前 N 名 / 后 N 名都是 LIMIT N 的索引扫描
+            CREATE INDEX IF NOT EXISTS ratings_net_idx ON ratings ((rec - black) DESC, user_id);
             
+            -- 每个群内的信誉汇总，与 ratings 在同一条投票语句里累加
+            CREATE TABLE IF NOT EXISTS chat_ratings (
+                chat_id BIGINT NOT NULL,
+                user_id BIGINT NOT NULL,
+                rec INTEGER DEFAULT 0,
+                black INTEGER DEFAULT 0,
+                -- 时间衰减分：score 是 score_at 时刻的值，读取和投票时按群的半衰期折算到当前时刻
+                score DOUBLE PRECISION DEFAULT 0,
+                score_at TIMESTAMP WITH TIME ZONE DEFAULT NOW(),
+                PRIMARY KEY (chat_id, user_id)
+            );
+            CREATE INDEX IF NOT EXISTS chat_ratings_net_idx ON chat_ratings (chat_id, (rec - black) DESC, user_id);
+            CREATE INDEX IF NOT EXISTS chat_ratings_user_id_idx ON chat_ratings (user_id);
+            
+            -- 每个 (群, 投票人, 目标, 类型) 的最近一次投票，只用于 24h 冷却检查；
+            -- 超过 24 小时的行由 maintain_vote_ledger 定期清理，表的大小只取决于最近一天的投票量
             CREATE TABLE IF NOT EXISTS votes (
                 chat_id BIGINT NOT NULL, 
                 voter_id BIGINT NOT NULL, 
@@ -47,6 +173,20 @@ async def init_schema():
                 PRIMARY KEY(chat_id, voter_id, target_id, type)
             );
             
+            -- 投票流水：只追加，按月分区 (vote_ledger_pYYYYMM)，过期分区整体删除。
+            -- 默认分区兜底，接住尚未创建分区的月份
+            CREATE TABLE IF NOT EXISTS vote_ledger (
+                id BIGSERIAL,
+                time TIMESTAMP WITH TIME ZONE NOT NULL DEFAULT NOW(),
+                chat_id BIGINT NOT NULL,
+                voter_id BIGINT NOT NULL,
+                target_id BIGINT NOT NULL,
+                type VARCHAR(10) NOT NULL,
+                evidence_msg_id BIGINT,
+                PRIMARY KEY (time, id)
+            ) PARTITION BY RANGE (time);
+            CREATE TABLE IF NOT EXISTS vote_ledger_default PARTITION OF vote_ledger DEFAULT;
+            
             CREATE TABLE IF NOT EXISTS admins (user_id BIGINT PRIMARY KEY);
             CREATE TABLE IF NOT EXISTS allowed_chats (chat_id BIGINT PRIMARY KEY);
             
@@ -56,6 +196,8 @@ async def init_schema():
                 username VARCHAR(32),
                 time TIMESTAMP WITH TIME ZONE DEFAULT NOW() 
             ); 
+            -- Web 管理面板按封禁时间倒序分页
+            CREATE INDEX IF NOT EXISTS banned_users_time_idx ON banned_users (time DESC, user_id DESC);
             
             CREATE TABLE IF NOT EXISTS bot_settings (key VARCHAR(50) PRIMARY KEY, value TEXT);
             
@@ -64,12 +206,265 @@ async def init_schema():
                 min_join_days INTEGER DEFAULT 0,    
                 force_channel_id BIGINT DEFAULT 0   
             );
+            -- 本群分数的衰减半衰期 (天)，0 表示不衰减
+            ALTER TABLE chat_settings ADD COLUMN IF NOT EXISTS decay_half_life_days INTEGER DEFAULT 0;
+            
+            -- username -> user_id 映射，来自 Bot 见过的 from_user，避免反复调用 get_chat
+            CREATE TABLE IF NOT EXISTS usernames (
+                username VARCHAR(32) PRIMARY KEY,
+                user_id BIGINT NOT NULL,
+                updated_at TIMESTAMP WITH TIME ZONE DEFAULT NOW()
+            );
+            CREATE INDEX IF NOT EXISTS usernames_user_id_idx ON usernames (user_id);
+            
+            -- 批量封禁任务：每个 (群, 用户) 一行，进程重启后从 pending 行继续
+            CREATE TABLE IF NOT EXISTS ban_jobs (
+                job_id BIGSERIAL PRIMARY KEY,
+                created_at TIMESTAMP WITH TIME ZONE DEFAULT NOW(),
+                finished_at TIMESTAMP WITH TIME ZONE,
+                owner VARCHAR(64),                  -- 正在执行该任务的进程
+                heartbeat TIMESTAMP WITH TIME ZONE, -- 执行者租约，过期后其他进程可接手
+                report_chat_id BIGINT,              -- 进度汇报消息所在的私聊
+                report_msg_id BIGINT
+            );
+            
+            CREATE TABLE IF NOT EXISTS ban_tasks (
+                job_id BIGINT NOT NULL REFERENCES ban_jobs (job_id) ON DELETE CASCADE,
+                chat_id BIGINT NOT NULL,
+                user_id BIGINT NOT NULL,
+                status VARCHAR(10) NOT NULL DEFAULT 'pending', -- pending / done / failed
+                attempts INTEGER DEFAULT 0,
+                last_error TEXT,
+                PRIMARY KEY (job_id, chat_id, user_id)
+            );
+            CREATE INDEX IF NOT EXISTS ban_tasks_pending_idx ON ban_tasks (job_id) WHERE status = 'pending';
+            
+            -- 每个群当前的信誉卡片，多实例共享，避免重复卡片
+            CREATE TABLE IF NOT EXISTS chat_cards (
+                chat_id BIGINT PRIMARY KEY,
+                message_id BIGINT NOT NULL,
+                updated_at TIMESTAMP WITH TIME ZONE DEFAULT NOW()
+            );
+            
+            -- 行数计数器 (Web 统计用)，由触发器在写入的同一事务内维护。
+            -- 按后端进程分成多个 shard，避免所有投票争抢同一行；读取时求和
+            CREATE TABLE IF NOT EXISTS stat_counters (
+                name VARCHAR(32) NOT NULL,
+                shard SMALLINT NOT NULL,
+                value BIGINT NOT NULL DEFAULT 0,
+                PRIMARY KEY (name, shard)
+            );
+            
+            CREATE OR REPLACE FUNCTION bump_stat_counter() RETURNS TRIGGER AS $$
+            DECLARE
+                delta BIGINT;
+            BEGIN
+                IF TG_OP = 'INSERT' THEN
+                    SELECT COUNT(*) INTO delta FROM new_rows;
+                ELSE
+                    SELECT -COUNT(*) INTO delta FROM old_rows;
+                END IF;
+                IF delta <> 0 THEN
+                    INSERT INTO stat_counters (name, shard, value) VALUES (TG_ARGV[0], pg_backend_pid() % 16, delta)
+                    ON CONFLICT (name, shard) DO UPDATE SET value = stat_counters.value + EXCLUDED.value;
+                END IF;
+                RETURN NULL;
+            END;
+            $$ LANGUAGE plpgsql;
+            
+            -- 第一次创建触发器时，用一次 COUNT(*) 作为计数器初始值
+            DO $$
+            DECLARE
+                t TEXT;
+            BEGIN
+                FOREACH t IN ARRAY ARRAY['ratings', 'vote_ledger'] LOOP
+                    IF NOT EXISTS (SELECT 1 FROM pg_trigger WHERE tgname = t || '_count_ins') THEN
+                        EXECUTE format('LOCK TABLE %I IN SHARE MODE', t);
+                        EXECUTE format('CREATE TRIGGER %I AFTER INSERT ON %I REFERENCING NEW TABLE AS new_rows
+                                        FOR EACH STATEMENT EXECUTE FUNCTION bump_stat_counter(%L)', t || '_count_ins', t, t);
+                        EXECUTE format('CREATE TRIGGER %I AFTER DELETE ON %I REFERENCING OLD TABLE AS old_rows
+                                        FOR EACH STATEMENT EXECUTE FUNCTION bump_stat_counter(%L)', t || '_count_del', t, t);
+                        DELETE FROM stat_counters WHERE name = t;
+                        EXECUTE format('INSERT INTO stat_counters (name, shard, value) SELECT %L, 0, COUNT(*) FROM %I', t, t);
+                    END IF;
+                END LOOP;
+            END;
+            $$;
         ''')
-        
-        await conn.execute("""
-            INSERT INTO bot_settings (key, value) VALUES ($1, $2) 
-            ON CONFLICT (key) DO NOTHING
-        """, 'welcome', '<b>狼猎信誉系统</b>\n\n@用户查看信誉\n推荐+1 拉黑-1\n24h内同人只能投一次')
+    await conn.execute("""
+        INSERT INTO bot_settings (key, value) VALUES ($1, $2) 
+        ON CONFLICT (key) DO NOTHING
+    """, 'welcome', '<b>狼猎信誉系统</b>\n\n@用户查看信誉\n推荐+1 拉黑-1\n24h内同人只能投一次')
+
+async def backfill_vote_ledger(conn):
+    """版本 2：投票流水为空时，把 votes 中的历史投票导入流水 (连同所需月份的分区)"""
+    if await conn.fetchval("SELECT EXISTS (SELECT 1 FROM vote_ledger)"):
+        return
+    oldest = await conn.fetchval("SELECT MIN(time) FROM votes")
+    if not oldest:
+        return
+    month = oldest.astimezone(timezone.utc).date().replace(day=1)
+    this_month = datetime.now(timezone.utc).date().replace(day=1)
+    while month <= this_month:
+        await create_ledger_partition(conn, month)
+        month = add_months(month, 1)
+    await conn.execute("""
+        INSERT INTO vote_ledger (time, chat_id, voter_id, target_id, type, evidence_msg_id)
+        SELECT time, chat_id, voter_id, target_id, type, evidence_msg_id FROM votes ORDER BY time
+    """)
+
+async def backfill_chat_ratings(conn):
+    """版本 3：chat_ratings 为空时，从投票流水汇总出每个群的分数"""
+    if await conn.fetchval("SELECT EXISTS (SELECT 1 FROM chat_ratings)"):
+        return
+    await conn.execute("""
+        INSERT INTO chat_ratings (chat_id, user_id, rec, black, score)
+        SELECT chat_id, target_id, COUNT(*) FILTER (WHERE type = 'rec'), COUNT(*) FILTER (WHERE type = 'black'),
+               COUNT(*) FILTER (WHERE type = 'rec') - COUNT(*) FILTER (WHERE type = 'black')
+        FROM vote_ledger GROUP BY chat_id, target_id
+    """)
+
+async def add_vote_user_indexes(conn):
+    """版本 4：按投票人 / 被投票人查询的索引 (用户投票记录分页、清理用户数据)。
+    在分区表上创建时会同时建到每个分区，之后新建的分区自动带上"""
+    await conn.execute("""
+        CREATE INDEX IF NOT EXISTS vote_ledger_target_idx ON vote_ledger (target_id, time DESC, id DESC);
+        CREATE INDEX IF NOT EXISTS vote_ledger_voter_idx ON vote_ledger (voter_id, time DESC, id DESC);
+        CREATE INDEX IF NOT EXISTS votes_target_idx ON votes (target_id);
+        CREATE INDEX IF NOT EXISTS votes_voter_idx ON votes (voter_id);
+    """)
+
+async def add_username_search_indexes(conn):
+    """版本 5：username 搜索索引。
+    前缀匹配用 C 排序规则的表达式索引：同一个索引既能做范围查找，又能按顺序输出，LIMIT N 只读 N 行；
+    模糊匹配需要 pg_trgm 扩展，没有权限或服务器未提供时跳过 (此时只有前缀搜索)"""
+    await conn.execute("""
+        CREATE INDEX IF NOT EXISTS ratings_username_search_idx ON ratings ((lower(username) COLLATE "C"));
+        CREATE INDEX IF NOT EXISTS banned_users_username_search_idx ON banned_users ((lower(username) COLLATE "C"));
+
+        DO $$
+        BEGIN
+            CREATE EXTENSION IF NOT EXISTS pg_trgm;
+        EXCEPTION WHEN OTHERS THEN
+            RAISE NOTICE 'pg_trgm unavailable, fuzzy username search disabled: %', SQLERRM;
+        END;
+        $$;
+
+        DO $$
+        BEGIN
+            IF EXISTS (SELECT 1 FROM pg_extension WHERE extname = 'pg_trgm') THEN
+                CREATE INDEX IF NOT EXISTS ratings_username_trgm_idx ON ratings USING gin (lower(username) gin_trgm_ops);
+                CREATE INDEX IF NOT EXISTS banned_users_username_trgm_idx ON banned_users USING gin (lower(username) gin_trgm_ops);
+            END IF;
+        END;
+        $$;
+    """)
+
+MIGRATIONS = [
+    (1, 'baseline schema', migrate_baseline),
+    (2, 'backfill vote ledger from votes', backfill_vote_ledger),
+    (3, 'backfill chat ratings from vote ledger', backfill_chat_ratings),
+    (4, 'vote voter/target indexes', add_vote_user_indexes),
+    (5, 'username search indexes', add_username_search_indexes),
+]
+SCHEMA_VERSION = MIGRATIONS[-1][0]
+
+async def get_schema_version(conn=None):
+    """当前已应用的最高版本；还没有迁移记录时返回 0"""
+    if conn is None:
+        async with db_pool.acquire() as conn:
+            return await get_schema_version(conn)
+    if not await conn.fetchval("SELECT to_regclass('schema_migrations')"):
+        return 0
+    return await conn.fetchval("SELECT COALESCE(MAX(version), 0) FROM schema_migrations")
+
+async def init_schema():
+    """执行尚未应用的迁移。
+    已是最新版本时只有一次无锁的版本查询，不执行任何 DDL，多实例滚动重启互不阻塞；
+    需要迁移时由咨询锁保证只有一个实例执行，其他实例等它完成后发现已是最新，直接跳过。"""
+    await init_db_pool()
+
+    async with db_pool.acquire() as conn:
+        if await get_schema_version(conn) >= SCHEMA_VERSION:
+            return
+        await conn.execute("SELECT pg_advisory_lock($1)", MIGRATION_LOCK_ID)
+        try:
+            await conn.execute("""
+                CREATE TABLE IF NOT EXISTS schema_migrations (
+                    version INTEGER PRIMARY KEY,
+                    name TEXT NOT NULL,
+                    applied_at TIMESTAMP WITH TIME ZONE DEFAULT NOW()
+                )
+            """)
+            applied = {row['version'] for row in await conn.fetch("SELECT version FROM schema_migrations")}
+            for version, name, step in MIGRATIONS:
+                if version in applied:
+                    continue
+                started = time.perf_counter()
+                # 每个版本在独立事务中执行，失败时整体回滚，下次启动重试
+                async with conn.transaction():
+                    await step(conn)
+                    await conn.execute("INSERT INTO schema_migrations (version, name) VALUES ($1, $2)", version, name)
+                print(f"Applied migration {version} ({name}) in {time.perf_counter() - started:.2f}s")
+        finally:
+            await conn.execute("SELECT pg_advisory_unlock($1)", MIGRATION_LOCK_ID)
+
+def add_months(month, n: int):
+    year, index = divmod(month.month - 1 + n, 12)
+    return month.replace(year=month.year + year, month=index + 1)
+
+async def create_ledger_partition(conn, month):
+    """创建某个月 (UTC) 的投票流水分区。默认分区里已有的该月数据先搬进新表，再挂载为分区"""
+    name = f"vote_ledger_p{month:%Y%m}"
+    if await conn.fetchval("SELECT to_regclass($1)", name):
+        return
+    start = datetime(month.year, month.month, 1, tzinfo=timezone.utc)
+    end = add_months(start, 1)
+    await conn.execute(f"CREATE TABLE {name} (LIKE vote_ledger INCLUDING DEFAULTS INCLUDING CONSTRAINTS)")
+    # 直接操作分区不会触发父表上的计数触发器，搬运不改变总数
+    await conn.execute(f"""
+        WITH m AS (DELETE FROM vote_ledger_default WHERE time >= $1 AND time < $2 RETURNING *)
+        INSERT INTO {name} SELECT * FROM m
+    """, start, end)
+    await conn.execute(
+        f"ALTER TABLE vote_ledger ATTACH PARTITION {name} FOR VALUES FROM ('{start.isoformat()}') TO ('{end.isoformat()}')"
+    )
+
+async def maintain_vote_ledger(retention_months: int = None):
+    """投票流水维护 (启动后在后台定期执行)：
+    1. 创建当前及之后 LEDGER_MONTHS_AHEAD 个月的分区；
+    2. 删除超过保留期的整月分区 (同时扣减计数器)；
+    3. 清理 votes 里已过冷却期的行。"""
+    if retention_months is None:
+        retention_months = VOTE_RETENTION_MONTHS
+    this_month = datetime.now(timezone.utc).date().replace(day=1)
+    async with db_pool.acquire() as conn:
+        async with conn.transaction():
+            if not await conn.fetchval("SELECT pg_try_advisory_xact_lock($1)", LEDGER_LOCK_ID):
+                return
+
+            for i in range(LEDGER_MONTHS_AHEAD + 1):
+                await create_ledger_partition(conn, add_months(this_month, i))
+
+            if retention_months > 0:
+                cutoff = add_months(this_month, -retention_months)
+                partitions = await conn.fetch("""
+                    SELECT c.relname FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid
+                    WHERE i.inhparent = 'vote_ledger'::regclass AND c.relname ~ '^vote_ledger_p[0-9]{6}$'
+                """)
+                for row in partitions:
+                    name = row['relname']
+                    if datetime.strptime(name[-6:], '%Y%m').date() >= cutoff:
+                        continue
+                    # DROP 不会触发 DELETE 触发器，手动扣减计数
+                    await conn.execute(f"""
+                        INSERT INTO stat_counters (name, shard, value) SELECT 'vote_ledger', 0, -COUNT(*) FROM {name}
+                        ON CONFLICT (name, shard) DO UPDATE SET value = stat_counters.value + EXCLUDED.value
+                    """)
+                    await conn.execute(f"DROP TABLE {name}")
+                    print(f"Dropped expired vote ledger partition {name}")
+
+            await conn.execute("DELETE FROM votes WHERE time < NOW() - INTERVAL '24 hours'")
 
 # --- 核心操作函数 (省略，与之前一致) ---
 
@@ -78,66 +473,452 @@ async def get_stats(user_id: int):
         row = await conn.fetchrow("SELECT rec, black, username FROM ratings WHERE user_id = $1", user_id)
         return (row['rec'], row['black'], row['username']) if row else (0, 0, None)
 
-async def add_vote(chat_id: int, voter_id: int, target_id: int, typ: str, username: str, evidence_msg_id: int = None):
+def decayed_score_sql(score: str, at: str, half_life: str) -> str:
+    """SQL 表达式：把 at 时刻的分数按半衰期 (天) 衰减到当前时刻；半衰期为 0 时原样返回。
+    指数上限 1000 (0.5^1000 已可忽略)，避免 power() 下溢报错"""
+    return (f"CASE WHEN {half_life} > 0 THEN {score} * power(0.5, LEAST(EXTRACT(EPOCH FROM NOW() - {at})::FLOAT8"
+            f" / ({half_life} * 86400.0), 1000)) ELSE {score} END")
+
+async def get_card_stats(chat_id: int, user_id: int, half_life_days: int = 0):
+    """卡片用：一次主键查询同时取出全局和本群的 (rec, black, chat_rec, chat_black, chat_score)。
+    chat_score 为衰减到当前时刻的本群分数，读取时计算，不需要回写"""
     async with db_pool.acquire() as conn:
-        col = "rec" if typ == "rec" else "black"
-        await conn.execute(f"""
-            INSERT INTO ratings (user_id, username, {col}) VALUES ($1, $2, 1) 
-            ON CONFLICT (user_id) DO UPDATE SET {col}=ratings.{col}+1, username=EXCLUDED.username
-        """, target_id, username)
-        await conn.execute(f"""
+        row = await conn.fetchrow(f"""
+            SELECT r.rec, r.black, COALESCE(c.rec, 0) AS chat_rec, COALESCE(c.black, 0) AS chat_black,
+                   COALESCE({decayed_score_sql('c.score', 'c.score_at', '$3')}, 0) AS chat_score
+            FROM ratings r LEFT JOIN chat_ratings c ON c.chat_id = $1 AND c.user_id = r.user_id
+            WHERE r.user_id = $2
+        """, chat_id, user_id, half_life_days)
+        return tuple(row) if row else (0, 0, 0, 0, 0.0)
+
+def vote_sql(typ: str) -> str:
+    """原子投票语句：24h 冷却检查、追加投票流水、累加全局及本群计数。
+    参数: chat_id, voter_id, target_id, type, username, evidence_msg_id, half_life_days
+    并发的重复点击会在 votes 主键行上排队，后到者看到新的 time 后被 WHERE 拒绝，不会重复计数。
+    本群衰减分先按 half_life_days 折算到当前时刻再加减 1，每票 O(1)，与历史票数无关。"""
+    col = "rec" if typ == "rec" else "black"
+    delta = 1 if typ == "rec" else -1
+    return f"""
+        WITH v AS (
             INSERT INTO votes (chat_id, voter_id, target_id, type, time, evidence_msg_id) 
-            VALUES ($1, $2, $3, $4, NOW(), $5) 
+            VALUES ($1, $2, $3, $4, NOW(), $6) 
             ON CONFLICT (chat_id, voter_id, target_id, type) DO UPDATE SET time = EXCLUDED.time, evidence_msg_id = EXCLUDED.evidence_msg_id
-        """, chat_id, voter_id, target_id, typ, evidence_msg_id)
+            WHERE votes.time <= NOW() - INTERVAL '24 hours'
+            RETURNING chat_id, voter_id, target_id, type, time, evidence_msg_id
+        ), l AS (
+            INSERT INTO vote_ledger (time, chat_id, voter_id, target_id, type, evidence_msg_id)
+            SELECT time, chat_id, voter_id, target_id, type, evidence_msg_id FROM v
+        ), c AS (
+            INSERT INTO chat_ratings (chat_id, user_id, {col}, score, score_at) SELECT $1, $3, 1, {delta}, NOW() FROM v
+            ON CONFLICT (chat_id, user_id) DO UPDATE SET {col}=chat_ratings.{col}+1,
+                score = {decayed_score_sql('chat_ratings.score', 'chat_ratings.score_at', '$7')} + EXCLUDED.score,
+                score_at = EXCLUDED.score_at
+            RETURNING rec, black, score
+        ), g AS (
+            INSERT INTO ratings (user_id, username, {col}) SELECT $3, $5, 1 FROM v
+            ON CONFLICT (user_id) DO UPDATE SET {col}=ratings.{col}+1, username=EXCLUDED.username
+            RETURNING rec, black
+        )
+        SELECT g.rec, g.black, c.rec AS chat_rec, c.black AS chat_black, c.score AS chat_score FROM g, c
+    """
 
-async def can_vote(chat_id: int, voter_id: int, target_id: int, typ: str):
+async def add_vote(chat_id: int, voter_id: int, target_id: int, typ: str, username: str, evidence_msg_id: int = None,
+                   half_life_days: int = 0):
+    """同步投票：返回新的 (rec, black, chat_rec, chat_black, chat_score) (全局及本群)；冷却期内返回 None"""
     async with db_pool.acquire() as conn:
-        cutoff = datetime.now() - timedelta(hours=24)
-        row = await conn.fetchrow(
-            "SELECT 1 FROM votes WHERE chat_id=$1 AND voter_id=$2 AND target_id=$3 AND type=$4 AND time>$5", 
-            chat_id, voter_id, target_id, typ, cutoff
-        )
-        return row is None
+        row = await conn.fetchrow(vote_sql(typ), chat_id, voter_id, target_id, typ, username, evidence_msg_id, half_life_days)
+        return tuple(row) if row else None
+
+async def add_votes(votes):
+    """批量写入投票 (写缓冲模式)：一个事务内按类型 executemany 同一条原子投票语句，整批一次往返。
+    votes: [(chat_id, voter_id, target_id, type, username, evidence_msg_id, half_life_days), ...]
+    数据库端的冷却检查依然生效，重复的投票会被忽略"""
+    async with db_pool.acquire() as conn:
+        async with conn.transaction():
+            # 按类型分两次执行，同一个被投票人的行会在两次中各锁一次；多个进程同时落盘时加锁顺序不同会死锁。
+            # 先按固定顺序锁住本批涉及的全部被投票人，再写入
+            await conn.execute("""
+                SELECT pg_advisory_xact_lock($1, h) FROM (
+                    SELECT DISTINCT hashint8(t) AS h FROM unnest($2::BIGINT[]) t ORDER BY h
+                ) s
+            """, VOTE_LOCK_ID, list({v[2] for v in votes}))
+            for typ in ('rec', 'black'):
+                rows = [v for v in votes if v[3] == typ]
+                if rows:
+                    await conn.executemany(vote_sql(typ), rows)
+
+async def load_recent_votes():
+    """冷却期内的投票 (写缓冲模式启动时载入内存)：[(chat_id, voter_id, target_id, type, unix 时间), ...]"""
+    async with db_pool.acquire() as conn:
+        rows = await conn.fetch("""
+            SELECT chat_id, voter_id, target_id, type, EXTRACT(EPOCH FROM time)::FLOAT8 AS ts
+            FROM votes WHERE time > NOW() - INTERVAL '24 hours'
+        """)
+        return [tuple(row) for row in rows]
+
+async def get_top_ratings(limit: int, ascending: bool = False):
+    """全局净分排行 (ascending=True 为末位)，走 ratings_net_idx 正向或反向扫描"""
+    order = "ASC, user_id DESC" if ascending else "DESC, user_id ASC"
+    async with db_pool.acquire() as conn:
+        return await conn.fetch(f"SELECT user_id, username, rec, black FROM ratings ORDER BY (rec - black) {order} LIMIT $1", limit)
+
+async def get_chat_top_ratings(chat_id: int, limit: int, ascending: bool = False):
+    """某个群内的净分排行，走 chat_ratings_net_idx"""
+    order = "ASC, c.user_id DESC" if ascending else "DESC, c.user_id ASC"
+    async with db_pool.acquire() as conn:
+        return await conn.fetch(f"""
+            SELECT c.user_id, r.username, c.rec, c.black
+            FROM chat_ratings c LEFT JOIN ratings r ON r.user_id = c.user_id
+            WHERE c.chat_id = $1
+            ORDER BY (c.rec - c.black) {order} LIMIT $2
+        """, chat_id, limit)
 
 async def is_banned(user_id: int):
     async with db_pool.acquire() as conn:
         row = await conn.fetchrow("SELECT 1 FROM banned_users WHERE user_id = $1", user_id)
         return row is not None
 
-async def get_banned_list():
-    try:
-        async with db_pool.acquire() as conn:
-            return await conn.fetch("SELECT user_id, username, time FROM banned_users")
-    except Exception as e:
-        print(f"Database Error in get_banned_list: {e}")
-        return []
+async def load_banned_ids():
+    async with db_pool.acquire() as conn:
+        rows = await conn.fetch("SELECT user_id FROM banned_users")
+        return {row['user_id'] for row in rows}
+
+async def get_banned_page(limit: int = 50, after=None):
+    """按封禁时间倒序的一页封禁用户。after: 上一页最后一行的 (time, user_id)，走 banned_users_time_idx。
+    time 为空的旧记录在倒序中排在最前面 (NULLS FIRST)，after[0] 为 None 表示上一页停在这一段"""
+    async with db_pool.acquire() as conn:
+        if after is None:
+            return await conn.fetch("""
+                SELECT user_id, username, time FROM banned_users
+                ORDER BY time DESC, user_id DESC LIMIT $1
+            """, limit)
+        if after[0] is None:
+            return await conn.fetch("""
+                SELECT user_id, username, time FROM banned_users
+                WHERE time IS NOT NULL OR user_id < $2
+                ORDER BY time DESC, user_id DESC LIMIT $1
+            """, limit, after[1])
+        return await conn.fetch("""
+            SELECT user_id, username, time FROM banned_users
+            WHERE (time, user_id) < ($2, $3)
+            ORDER BY time DESC, user_id DESC LIMIT $1
+        """, limit, after[0], after[1])
+
+async def iter_banned_users():
+    """服务端游标逐批读取全部封禁用户，内存占用与表大小无关"""
+    async with db_pool.acquire() as conn:
+        async with conn.transaction():
+            async for row in conn.cursor("SELECT user_id, username, time FROM banned_users ORDER BY user_id", prefetch=1000):
+                yield row
 
 async def unban_user(user_id: int):
     async with db_pool.acquire() as conn:
-        await conn.execute("DELETE FROM banned_users WHERE user_id = $1", user_id)
+        await conn.execute("""
+            WITH d AS (DELETE FROM banned_users WHERE user_id = $1 RETURNING user_id)
+            SELECT pg_notify($2, '-' || user_id) FROM d
+        """, user_id, BANNED_CHANNEL)
 
 async def ban_user(user_id: int, username: str):
     async with db_pool.acquire() as conn:
-        await conn.execute("INSERT INTO banned_users (user_id, username, time) VALUES ($1, $2, NOW()) ON CONFLICT (user_id) DO UPDATE SET username=EXCLUDED.username, time=NOW()", user_id, username)
+        await conn.execute("""
+            WITH i AS (
+                INSERT INTO banned_users (user_id, username, time) VALUES ($1, $2, NOW())
+                ON CONFLICT (user_id) DO UPDATE SET username=EXCLUDED.username, time=NOW()
+                RETURNING user_id
+            )
+            SELECT pg_notify($3, '+' || user_id) FROM i
+        """, user_id, username, BANNED_CHANNEL)
+
+async def create_ban_job(users):
+    """批量封禁：写入 banned_users 并为每个授权群 x 每个用户生成一条待执行的踢出任务。
+    users: [(user_id, username), ...]；返回 (job_id, 任务总数)"""
+    users = dict(users)  # 去重：同一条 INSERT 不能两次更新同一行
+    user_ids, usernames = list(users), list(users.values())
+    async with db_pool.acquire() as conn:
+        async with conn.transaction():
+            await conn.execute("""
+                WITH i AS (
+                    INSERT INTO banned_users (user_id, username, time)
+                    SELECT u.user_id, u.username, NOW() FROM unnest($1::BIGINT[], $2::VARCHAR[]) AS u(user_id, username)
+                    ON CONFLICT (user_id) DO UPDATE SET username=COALESCE(EXCLUDED.username, banned_users.username), time=NOW()
+                    RETURNING user_id
+                )
+                SELECT pg_notify($3, '+' || user_id) FROM i
+            """, user_ids, usernames, BANNED_CHANNEL)
+            job_id = await conn.fetchval("INSERT INTO ban_jobs DEFAULT VALUES RETURNING job_id")
+            total = await conn.fetchval("""
+                WITH t AS (
+                    INSERT INTO ban_tasks (job_id, chat_id, user_id)
+                    SELECT $1, a.chat_id, u.user_id FROM allowed_chats a CROSS JOIN unnest($2::BIGINT[]) AS u(user_id)
+                    ON CONFLICT DO NOTHING
+                    RETURNING 1
+                )
+                SELECT COUNT(*) FROM t
+            """, job_id, user_ids)
+            await conn.execute("SELECT pg_notify($1, $2)", BAN_JOBS_CHANNEL, str(job_id))
+        return job_id, total
+
+async def claim_ban_job(job_id: int, owner: str):
+    """获取或续约任务的执行权；其他进程持有未过期的租约时返回 False"""
+    async with db_pool.acquire() as conn:
+        row = await conn.fetchrow("""
+            UPDATE ban_jobs SET owner = $2, heartbeat = NOW()
+            WHERE job_id = $1 AND finished_at IS NULL
+              AND (owner IS NULL OR owner = $2 OR heartbeat < NOW() - INTERVAL '2 minutes')
+            RETURNING job_id
+        """, job_id, owner)
+        return row is not None
+
+async def get_unfinished_ban_jobs():
+    async with db_pool.acquire() as conn:
+        rows = await conn.fetch("SELECT job_id FROM ban_jobs WHERE finished_at IS NULL ORDER BY job_id")
+        return [row['job_id'] for row in rows]
+
+async def get_pending_ban_tasks(job_id: int, limit: int = 500):
+    async with db_pool.acquire() as conn:
+        return await conn.fetch("""
+            SELECT chat_id, user_id, attempts FROM ban_tasks
+            WHERE job_id = $1 AND status = 'pending' LIMIT $2
+        """, job_id, limit)
+
+async def update_ban_task(job_id: int, chat_id: int, user_id: int, status: str, attempts: int, error: str = None):
+    async with db_pool.acquire() as conn:
+        await conn.execute("""
+            UPDATE ban_tasks SET status = $4, attempts = $5, last_error = $6
+            WHERE job_id = $1 AND chat_id = $2 AND user_id = $3
+        """, job_id, chat_id, user_id, status, attempts, error)
+
+async def get_ban_job(job_id: int):
+    """任务进度：各状态的数量及汇报消息位置；任务不存在时返回 None"""
+    async with db_pool.acquire() as conn:
+        return await conn.fetchrow("""
+            SELECT j.job_id, j.created_at, j.finished_at, j.report_chat_id, j.report_msg_id,
+                   COUNT(t.*) AS total,
+                   COUNT(t.*) FILTER (WHERE t.status = 'done') AS done,
+                   COUNT(t.*) FILTER (WHERE t.status = 'failed') AS failed
+            FROM ban_jobs j LEFT JOIN ban_tasks t ON t.job_id = j.job_id
+            WHERE j.job_id = $1
+            GROUP BY j.job_id
+        """, job_id)
+
+async def set_ban_job_report(job_id: int, report_chat_id: int, report_msg_id: int):
+    async with db_pool.acquire() as conn:
+        await conn.execute(
+            "UPDATE ban_jobs SET report_chat_id = $2, report_msg_id = $3 WHERE job_id = $1",
+            job_id, report_chat_id, report_msg_id
+        )
+
+async def finish_ban_job(job_id: int):
+    async with db_pool.acquire() as conn:
+        await conn.execute("UPDATE ban_jobs SET finished_at = NOW(), owner = NULL WHERE job_id = $1", job_id)
 
 async def clear_user_data(user_id: int):
+    # 两个条件分别走 voter / target 索引 (BitmapOr)，不扫描整张表
     async with db_pool.acquire() as conn:
         await conn.execute("DELETE FROM ratings WHERE user_id = $1", user_id)
+        await conn.execute("DELETE FROM chat_ratings WHERE user_id = $1", user_id)
         await conn.execute("DELETE FROM votes WHERE target_id = $1 OR voter_id = $1", user_id)
+        await conn.execute("DELETE FROM vote_ledger WHERE target_id = $1 OR voter_id = $1", user_id)
+
+# --- 用户资料 ---
+# 每个群的分数最多返回的条数
+PROFILE_CHATS_LIMIT = 50
+
+def evidence_link(chat_id: int, msg_id: int):
+    """超级群消息链接 https://t.me/c/<内部ID>/<消息ID>；普通群没有消息链接，返回 None"""
+    if not msg_id or not str(chat_id).startswith('-100'):
+        return None
+    return f"https://t.me/c/{str(chat_id)[4:]}/{msg_id}"
+
+async def get_user_profile(user_id: int):
+    """用户概况：全局分数、最近的 username、是否被封禁，以及各群的分数 (按本群净分降序，
+    本群分数按该群的半衰期衰减到当前时刻)。用户不存在时 rec/black 为 0"""
+    async with db_pool.acquire() as conn:
+        row = await conn.fetchrow("""
+            SELECT COALESCE(r.rec, 0) AS rec, COALESCE(r.black, 0) AS black,
+                   COALESCE(r.username, (SELECT username FROM usernames WHERE user_id = $1 ORDER BY updated_at DESC LIMIT 1)) AS username,
+                   EXISTS (SELECT 1 FROM banned_users WHERE user_id = $1) AS banned
+            FROM (SELECT $1::BIGINT AS user_id) u LEFT JOIN ratings r ON r.user_id = u.user_id
+        """, user_id)
+        chats = await conn.fetch(f"""
+            SELECT c.chat_id, c.rec, c.black, c.rec - c.black AS net, COALESCE(s.decay_half_life_days, 0) AS half_life_days,
+                   {decayed_score_sql('c.score', 'c.score_at', 'COALESCE(s.decay_half_life_days, 0)')} AS score
+            FROM chat_ratings c LEFT JOIN chat_settings s ON s.chat_id = c.chat_id
+            WHERE c.user_id = $1
+            ORDER BY c.rec - c.black DESC, c.chat_id LIMIT $2
+        """, user_id, PROFILE_CHATS_LIMIT)
+        return row, chats
+
+async def get_user_votes(user_id: int, direction: str = 'received', limit: int = 20, before=None):
+    """用户的投票记录，按时间倒序分页。direction: received (收到的票) 或 cast (投出的票)；
+    before: 上一页最后一行的 (time, id)。走 vote_ledger_target_idx / vote_ledger_voter_idx，
+    各分区的索引按时间归并，只读取 limit 行，与流水总量无关"""
+    column, other = ('target_id', 'voter_id') if direction == 'received' else ('voter_id', 'target_id')
+    query = f"""
+        SELECT v.id, v.time, v.chat_id, v.voter_id, v.target_id, v.type, v.evidence_msg_id,
+               (SELECT username FROM usernames WHERE user_id = v.{other} ORDER BY updated_at DESC LIMIT 1) AS username
+        FROM vote_ledger v
+        WHERE v.{column} = $1 {{}}
+        ORDER BY v.time DESC, v.id DESC LIMIT $2
+    """
+    async with db_pool.acquire() as conn:
+        if before is None:
+            return await conn.fetch(query.format(""), user_id, limit)
+        return await conn.fetch(query.format("AND (v.time, v.id) < ($3, $4)"), user_id, limit, before[0], before[1])
+
+# --- username 搜索 (管理面板) ---
+# 是否有 trigram 索引 (首次搜索时检查)；没有时只做前缀匹配
+username_trgm = None
+
+SEARCH_PREFIX_SQL = """
+    WITH hits AS (
+        (SELECT user_id FROM ratings
+         WHERE lower(username) COLLATE "C" >= $1 AND lower(username) COLLATE "C" < $2
+         ORDER BY lower(username) COLLATE "C" LIMIT $3)
+        UNION
+        (SELECT user_id FROM banned_users
+         WHERE lower(username) COLLATE "C" >= $1 AND lower(username) COLLATE "C" < $2
+         ORDER BY lower(username) COLLATE "C" LIMIT $3)
+        UNION
+        SELECT $4::BIGINT WHERE $4::BIGINT IS NOT NULL
+    )
+    SELECT h.user_id, COALESCE(r.username, b.username) AS username, COALESCE(r.rec, 0) AS rec,
+           COALESCE(r.black, 0) AS black, b.user_id IS NOT NULL AS banned
+    FROM hits h LEFT JOIN ratings r ON r.user_id = h.user_id LEFT JOIN banned_users b ON b.user_id = h.user_id
+    WHERE r.user_id IS NOT NULL OR b.user_id IS NOT NULL
+    ORDER BY h.user_id IS NOT DISTINCT FROM $4 DESC, lower(COALESCE(r.username, b.username)) COLLATE "C", h.user_id
+    LIMIT $3
+"""
+
+SEARCH_FUZZY_SQL = """
+    WITH hits AS (
+        (SELECT user_id, similarity(lower(username), $1) AS sim FROM ratings
+         WHERE lower(username) % $1 OR lower(username) LIKE $2
+         ORDER BY sim DESC LIMIT $3)
+        UNION ALL
+        (SELECT user_id, similarity(lower(username), $1) AS sim FROM banned_users
+         WHERE lower(username) % $1 OR lower(username) LIKE $2
+         ORDER BY sim DESC LIMIT $3)
+    ), best AS (
+        SELECT user_id, MAX(sim) AS sim FROM hits GROUP BY user_id
+    )
+    SELECT h.user_id, COALESCE(r.username, b.username) AS username, COALESCE(r.rec, 0) AS rec,
+           COALESCE(r.black, 0) AS black, b.user_id IS NOT NULL AS banned
+    FROM best h LEFT JOIN ratings r ON r.user_id = h.user_id LEFT JOIN banned_users b ON b.user_id = h.user_id
+    ORDER BY h.sim DESC, h.user_id
+    LIMIT $3
+"""
+
+async def search_users(query: str, limit: int = 20):
+    """在有分数的用户和被封禁的用户中按 username 搜索 (纯数字时同时按 user_id 精确匹配)。
+    先取前缀匹配 (按 username 排序)，不足 limit 条时用 trigram 相似度和子串匹配补足。
+    返回 [(行, 'id' | 'prefix' | 'fuzzy')]"""
+    global username_trgm
+    q = query.strip().lstrip('@').lower()
+    if not q:
+        return []
+    # 前缀 q 的范围 [q, q 的最后一个字符 +1)，C 排序规则下即按码点比较
+    upper = q[:-1] + chr(ord(q[-1]) + 1)
+    # 只把 ASCII 数字且在 BIGINT 范围内的查询当作 user_id ('²' 之类的 Unicode 数字 isdigit() 也为真)
+    user_id = int(q) if q.isascii() and q.isdigit() and len(q) <= 19 else None
+    if user_id is not None and user_id >= 2**63:
+        user_id = None
+    async with db_pool.acquire() as conn:
+        rows = await conn.fetch(SEARCH_PREFIX_SQL, q, upper, limit, user_id)
+        results = [(row, 'id' if row['user_id'] == user_id else 'prefix') for row in rows]
+        if len(results) >= limit or len(q) < 3:
+            return results
+
+        if username_trgm is None:
+            username_trgm = await conn.fetchval("SELECT to_regclass('ratings_username_trgm_idx') IS NOT NULL")
+        if not username_trgm:
+            return results
+        pattern = '%' + q.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_') + '%'
+        seen = {row['user_id'] for row in rows}
+        for row in await conn.fetch(SEARCH_FUZZY_SQL, q, pattern, limit):
+            if row['user_id'] not in seen and len(results) < limit:
+                results.append((row, 'fuzzy'))
+        return results
+
+async def lookup_username(username: str):
+    async with db_pool.acquire() as conn:
+        return await conn.fetchval("SELECT user_id FROM usernames WHERE username = $1", username)
+
+async def load_known_usernames():
+    """所有已知 username (评分过的用户 + 见过的用户)，用于预过滤群消息"""
+    async with db_pool.acquire() as conn:
+        rows = await conn.fetch("""
+            SELECT lower(username) AS username FROM ratings WHERE username IS NOT NULL
+            UNION
+            SELECT username FROM usernames
+        """)
+        return [row['username'] for row in rows]
+
+async def save_username(user_id: int, username: str):
+    """记录 username -> user_id，同时清除该用户已经不再使用的旧 username"""
+    async with db_pool.acquire() as conn:
+        await conn.execute("""
+            WITH stale AS (
+                DELETE FROM usernames WHERE user_id = $1 AND username <> $2
+            )
+            INSERT INTO usernames (username, user_id, updated_at) VALUES ($2, $1, NOW())
+            ON CONFLICT (username) DO UPDATE SET user_id = EXCLUDED.user_id, updated_at = NOW()
+        """, user_id, username)
 
 async def get_chat_settings(chat_id: int):
     async with db_pool.acquire() as conn:
-        row = await conn.fetchrow("SELECT min_join_days, force_channel_id FROM chat_settings WHERE chat_id = $1", chat_id)
-        return row if row else {'min_join_days': 0, 'force_channel_id': 0}
+        row = await conn.fetchrow("SELECT min_join_days, force_channel_id, decay_half_life_days FROM chat_settings WHERE chat_id = $1", chat_id)
+        return row if row else {'min_join_days': 0, 'force_channel_id': 0, 'decay_half_life_days': 0}
+
+async def set_min_join_days(chat_id: int, days: int):
+    async with db_pool.acquire() as conn:
+        await conn.execute("""
+            WITH u AS (
+                INSERT INTO chat_settings (chat_id, min_join_days) VALUES ($1, $2)
+                ON CONFLICT (chat_id) DO UPDATE SET min_join_days = $2
+                RETURNING chat_id, min_join_days, force_channel_id, decay_half_life_days
+            )
+            SELECT pg_notify($3, chat_id || ':' || min_join_days || ':' || force_channel_id || ':' || decay_half_life_days) FROM u
+        """, chat_id, days, CHAT_SETTINGS_CHANNEL)
+
+async def set_force_channel(chat_id: int, channel_id: int):
+    async with db_pool.acquire() as conn:
+        await conn.execute("""
+            WITH u AS (
+                INSERT INTO chat_settings (chat_id, force_channel_id) VALUES ($1, $2)
+                ON CONFLICT (chat_id) DO UPDATE SET force_channel_id = $2
+                RETURNING chat_id, min_join_days, force_channel_id, decay_half_life_days
+            )
+            SELECT pg_notify($3, chat_id || ':' || min_join_days || ':' || force_channel_id || ':' || decay_half_life_days) FROM u
+        """, chat_id, channel_id, CHAT_SETTINGS_CHANNEL)
+
+async def set_decay_half_life(chat_id: int, days: int):
+    async with db_pool.acquire() as conn:
+        await conn.execute("""
+            WITH u AS (
+                INSERT INTO chat_settings (chat_id, decay_half_life_days) VALUES ($1, $2)
+                ON CONFLICT (chat_id) DO UPDATE SET decay_half_life_days = $2
+                RETURNING chat_id, min_join_days, force_channel_id, decay_half_life_days
+            )
+            SELECT pg_notify($3, chat_id || ':' || min_join_days || ':' || force_channel_id || ':' || decay_half_life_days) FROM u
+        """, chat_id, days, CHAT_SETTINGS_CHANNEL)
+
+async def get_chat_settings_page(limit: int = 50, after: int = None):
+    async with db_pool.acquire() as conn:
+        return await conn.fetch("""
+            SELECT chat_id, min_join_days, force_channel_id, decay_half_life_days FROM chat_settings
+            WHERE chat_id > $2 ORDER BY chat_id LIMIT $1
+        """, limit, after if after is not None else -(2 ** 63))
+
+async def iter_chat_settings():
+    async with db_pool.acquire() as conn:
+        async with conn.transaction():
+            async for row in conn.cursor("SELECT chat_id, min_join_days, force_channel_id, decay_half_life_days FROM chat_settings ORDER BY chat_id", prefetch=1000):
+                yield row
 
 async def get_chat_settings_list():
-    try:
-        async with db_pool.acquire() as conn:
-            return await conn.fetch("SELECT chat_id, min_join_days, force_channel_id FROM chat_settings")
-    except Exception as e:
-        print(f"Database Error in get_chat_settings_list: {e}")
-        return []
+    async with db_pool.acquire() as conn:
+        return await conn.fetch("SELECT chat_id, min_join_days, force_channel_id, decay_half_life_days FROM chat_settings")
 
 async def get_allowed_chats():
     async with db_pool.acquire() as conn:
@@ -145,7 +926,10 @@ async def get_allowed_chats():
 
 async def save_admin(uid: int):
     async with db_pool.acquire() as conn:
-        await conn.execute("INSERT INTO admins VALUES ($1) ON CONFLICT (user_id) DO NOTHING", uid)
+        await conn.execute("""
+            WITH i AS (INSERT INTO admins VALUES ($1) ON CONFLICT (user_id) DO NOTHING RETURNING user_id)
+            SELECT pg_notify($2, '+' || user_id) FROM i
+        """, uid, ADMINS_CHANNEL)
 
 async def load_admins():
     async with db_pool.acquire() as conn:
@@ -154,11 +938,39 @@ async def load_admins():
 
 async def save_group(gid: int):
     async with db_pool.acquire() as conn:
-        await conn.execute("INSERT INTO allowed_chats VALUES ($1) ON CONFLICT (chat_id) DO NOTHING", gid)
+        await conn.execute("""
+            WITH i AS (INSERT INTO allowed_chats VALUES ($1) ON CONFLICT (chat_id) DO NOTHING RETURNING chat_id)
+            SELECT pg_notify($2, '+' || chat_id) FROM i
+        """, gid, ALLOWED_CHATS_CHANNEL)
 
 async def del_group(gid: int):
     async with db_pool.acquire() as conn:
-        await conn.execute("DELETE FROM allowed_chats WHERE chat_id = $1", gid)
+        await conn.execute("""
+            WITH d AS (DELETE FROM allowed_chats WHERE chat_id = $1 RETURNING chat_id)
+            SELECT pg_notify($2, '-' || chat_id) FROM d
+        """, gid, ALLOWED_CHATS_CHANNEL)
+
+async def get_chat_card(chat_id: int):
+    async with db_pool.acquire() as conn:
+        return await conn.fetchval("SELECT message_id FROM chat_cards WHERE chat_id = $1", chat_id)
+
+async def swap_chat_card(chat_id: int, message_id: int):
+    """原子地登记新卡片并返回被替换的旧卡片 (由调用方删除)。
+    多个实例同时发卡片时，每张旧卡片只会返回给一个实例，最终只留下最后登记的那张"""
+    async with db_pool.acquire() as conn:
+        async with conn.transaction():
+            # 先保证行存在，之后所有实例都在同一行锁上排队
+            await conn.execute(
+                "INSERT INTO chat_cards (chat_id, message_id) VALUES ($1, 0) ON CONFLICT (chat_id) DO NOTHING", chat_id
+            )
+            old_id = await conn.fetchval("SELECT message_id FROM chat_cards WHERE chat_id = $1 FOR UPDATE", chat_id)
+            await conn.execute("""
+                WITH u AS (
+                    UPDATE chat_cards SET message_id = $2, updated_at = NOW() WHERE chat_id = $1 RETURNING chat_id
+                )
+                SELECT pg_notify($3, chat_id || ':' || $2) FROM u
+            """, chat_id, message_id, CHAT_CARDS_CHANNEL)
+            return old_id or None
 
 async def get_welcome_message():
     async with db_pool.acquire() as conn:
@@ -170,18 +982,33 @@ async def set_welcome_message(text: str):
         await conn.execute("INSERT INTO bot_settings (key, value) VALUES ($1, $2) ON CONFLICT (key) DO UPDATE SET value = EXCLUDED.value", 
                            'welcome', text)
 
-async def get_total_users():
+async def get_counter(name: str, estimate: bool = False):
+    """表行数：默认读取触发器维护的精确计数 (最多 16 行求和)；
+    estimate=True 时直接使用规划器统计 (pg_class.reltuples)，不读任何用户表；
+    分区表按各分区求和"""
+    async with db_pool.acquire() as conn:
+        if estimate:
+            value = await conn.fetchval("""
+                SELECT SUM(GREATEST(reltuples, 0))::BIGINT FROM pg_class
+                WHERE oid = to_regclass($1)
+                   OR oid IN (SELECT inhrelid FROM pg_inherits WHERE inhparent = to_regclass($1))
+            """, name)
+            return value or 0
+        return await conn.fetchval("SELECT COALESCE(SUM(value), 0)::BIGINT FROM stat_counters WHERE name = $1", name)
+
+async def get_total_users(estimate: bool = False):
     try:
-        async with db_pool.acquire() as conn:
-            return await conn.fetchval("SELECT COUNT(*) FROM ratings") or 0
+        return await get_counter('ratings', estimate)
     except Exception as e:
         print(f"Database Error in get_total_users: {e}")
         return 0
 
-async def get_total_votes():
+async def get_total_votes(estimate: bool = False):
     try:
-        async with db_pool.acquire() as conn:
-            return await conn.fetchval("SELECT COUNT(*) FROM votes") or 0
+        return await get_counter('vote_ledger', estimate)
     except Exception as e:
         print(f"Database Error in get_total_votes: {e}")
-        return 0
\ No newline at end of file
+        return 0
+
+# 所有 async 函数的耗时和异常计数 (db_function_seconds{function=...})
+metrics.instrument_module(globals(), __name__)
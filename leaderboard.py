@@ -0,0 +1,105 @@
+"""净分 (rec - black) 排行榜：内存里维护前 N 名和后 N 名，读取时不查数据库。
+
+本进程的投票直接增量更新名单；名单之外的人可能挤进来、或榜上的人掉出名单时，
+从 ratings_net_idx / chat_ratings_net_idx 重新取一次 (LIMIT N 的索引扫描，不排序整张表)。
+其他实例 (以及 Web 进程) 的投票通过 ttl 到期后的重新加载可见。
+"""
+import time
+import asyncio
+from functools import partial
+import database
+from cache import TTLCache, SingleFlight
+
+TOP_SIZE = 10
+
+def make_entry(user_id: int, username: str, rec: int, black: int) -> dict:
+    return {'user_id': user_id, 'username': username, 'rec': rec, 'black': black, 'net': rec - black}
+
+class RankedList:
+    """按 key 排好序的前 size 名。complete 表示总行数不足 size，名单就是全部"""
+
+    def __init__(self, size: int, key):
+        self.size = size
+        self.key = key
+        self.entries = []
+        self.complete = False
+
+    def load(self, entries):
+        self.entries = sorted(entries, key=self.key)[:self.size]
+        self.complete = len(entries) < self.size
+
+    def apply(self, entry: dict) -> bool:
+        """用某个用户的新分数更新名单；返回 False 表示名单外可能有人排得更前，需要重新加载"""
+        boundary = self.key(self.entries[-1]) if self.entries else None
+        present = next((i for i, e in enumerate(self.entries) if e['user_id'] == entry['user_id']), None)
+        if present is not None:
+            self.entries.pop(present)
+        # 名单外的人都排在 boundary 之后：新分数不差于 boundary 才能确定名次
+        if self.complete or self.key(entry) <= boundary:
+            self.entries.append(entry)
+            self.entries.sort(key=self.key)
+            if len(self.entries) > self.size:
+                del self.entries[self.size:]
+                self.complete = False
+            return True
+        return present is None
+
+class Leaderboard:
+    """一个范围 (全局或某个群) 的排行榜。loader(limit, ascending) 返回按净分排序的行"""
+
+    def __init__(self, loader, size: int = TOP_SIZE, ttl: float = 30):
+        self.loader = loader
+        self.size = size
+        self.ttl = ttl
+        self.top = RankedList(size, lambda e: (-e['net'], e['user_id']))
+        self.bottom = RankedList(size, lambda e: (e['net'], -e['user_id']))
+        self.expires = 0.0
+        self.loading = SingleFlight()
+
+    async def get(self):
+        """返回 (前 N 名, 后 N 名)；过期时重新加载，并发读取只加载一次"""
+        if time.monotonic() >= self.expires:
+            await self.loading.do(None, self.reload)
+        return self.top.entries, self.bottom.entries
+
+    async def reload(self):
+        top, bottom = await asyncio.gather(self.loader(self.size, False), self.loader(self.size, True))
+        self.top.load([make_entry(r['user_id'], r['username'], r['rec'], r['black']) for r in top])
+        self.bottom.load([make_entry(r['user_id'], r['username'], r['rec'], r['black']) for r in bottom])
+        self.expires = time.monotonic() + self.ttl
+
+    def apply(self, user_id: int, username: str, rec: int, black: int):
+        if not self.expires:
+            return  # 尚未加载或已失效，下次读取时整体重新加载
+        entry = make_entry(user_id, username, rec, black)
+        top_ok = self.top.apply(entry)
+        bottom_ok = self.bottom.apply(entry)
+        if not (top_ok and bottom_ok):
+            self.invalidate()
+
+    def invalidate(self):
+        self.expires = 0.0
+
+GLOBAL = Leaderboard(database.get_top_ratings)
+# 每个群的排行榜，只保留最近被查询过的群
+CHAT_BOARDS = TTLCache(maxsize=1000, ttl=3600)
+
+def board(chat_id: int = None) -> Leaderboard:
+    if chat_id is None:
+        return GLOBAL
+    chat_board = CHAT_BOARDS.get(chat_id)
+    if chat_board is None:
+        chat_board = Leaderboard(partial(database.get_chat_top_ratings, chat_id))
+        CHAT_BOARDS.set(chat_id, chat_board)
+    return chat_board
+
+async def get_leaderboard(chat_id: int = None):
+    """chat_id 为空时返回全局排行，否则返回该群内的排行"""
+    return await board(chat_id).get()
+
+def record_vote(chat_id: int, user_id: int, username: str, rec: int, black: int, chat_rec: int, chat_black: int):
+    """投票成功后调用，参数为 add_vote 返回的全局及本群总数"""
+    GLOBAL.apply(user_id, username, rec, black)
+    chat_board = CHAT_BOARDS.get(chat_id)
+    if chat_board:
+        chat_board.apply(user_id, username, chat_rec, chat_black)
@@ -0,0 +1,206 @@
+"""进程内指标，按 Prometheus 文本格式 (0.0.4) 输出。
+
+Bot 进程通过独立的 HTTP 端口 (METRICS_PORT，默认只监听 127.0.0.1，见 METRICS_HOST) 暴露 /metrics，Web 进程在 web.py 中暴露 /metrics (需要密钥)。
+指标只在本进程内累计：Gunicorn 多 Worker 或 Webhook 多进程时，每个进程各自一份。
+"""
+import time
+import math
+import inspect
+import functools
+from contextlib import contextmanager
+
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+REGISTRY = []
+
+def format_labels(names, values, extra=()) -> str:
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ""
+    escaped = (str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, v in pairs)
+    return "{" + ",".join(f'{k}="{v}"' for (k, _), v in zip(pairs, escaped)) + "}"
+
+def format_value(value: float) -> str:
+    if value == math.inf:
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+class Counter:
+    def __init__(self, name: str, doc: str, labels=()):
+        self.name, self.doc, self.labels = name, doc, tuple(labels)
+        self.values = {}
+        REGISTRY.append(self)
+
+    def inc(self, *labels, amount: float = 1):
+        self.values[labels] = self.values.get(labels, 0) + amount
+
+    def render(self):
+        yield f"# HELP {self.name} {self.doc}"
+        yield f"# TYPE {self.name} counter"
+        for labels, value in self.values.items():
+            yield f"{self.name}{format_labels(self.labels, labels)} {format_value(value)}"
+
+class Gauge:
+    """func 不为空时，每次输出时调用 func() 取值 (返回 {labels: value} 或单个数值)"""
+
+    def __init__(self, name: str, doc: str, labels=(), func=None):
+        self.name, self.doc, self.labels = name, doc, tuple(labels)
+        self.values = {}
+        self.func = func
+        REGISTRY.append(self)
+
+    def set(self, *labels, value: float):
+        self.values[labels] = value
+
+    def inc(self, *labels, amount: float = 1):
+        self.values[labels] = self.values.get(labels, 0) + amount
+
+    def dec(self, *labels, amount: float = 1):
+        self.inc(*labels, amount=-amount)
+
+    def render(self):
+        values = self.values
+        if self.func:
+            values = self.func()
+            if not isinstance(values, dict):
+                values = {(): values}
+        yield f"# HELP {self.name} {self.doc}"
+        yield f"# TYPE {self.name} gauge"
+        for labels, value in values.items():
+            yield f"{self.name}{format_labels(self.labels, labels)} {format_value(value)}"
+
+class Histogram:
+    def __init__(self, name: str, doc: str, labels=(), buckets=DEFAULT_BUCKETS):
+        self.name, self.doc, self.labels = name, doc, tuple(labels)
+        self.buckets = tuple(buckets) + (math.inf,)
+        # labels -> [每个桶的计数..., 总和, 总数]
+        self.values = {}
+        REGISTRY.append(self)
+
+    def observe(self, *labels, value: float):
+        data = self.values.get(labels)
+        if data is None:
+            data = self.values[labels] = [0] * len(self.buckets) + [0.0, 0]
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                data[i] += 1
+                break
+        data[-2] += value
+        data[-1] += 1
+
+    @contextmanager
+    def time(self, *labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(*labels, value=time.perf_counter() - start)
+
+    def render(self):
+        yield f"# HELP {self.name} {self.doc}"
+        yield f"# TYPE {self.name} histogram"
+        for labels, data in self.values.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets, data):
+                cumulative += count
+                le = format_labels(self.labels, labels, [('le', format_value(bound) if bound == math.inf else bound)])
+                yield f"{self.name}_bucket{le} {cumulative}"
+            yield f"{self.name}_sum{format_labels(self.labels, labels)} {format_value(data[-2])}"
+            yield f"{self.name}_count{format_labels(self.labels, labels)} {data[-1]}"
+
+def render() -> str:
+    lines = []
+    for metric in REGISTRY:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+# --- 各层的指标 ---
+HANDLER_SECONDS = Histogram('bot_handler_seconds', 'Time spent in aiogram handlers', ['handler'])
+HANDLER_ERRORS = Counter('bot_handler_errors_total', 'Exceptions raised by aiogram handlers', ['handler'])
+DB_SECONDS = Histogram('db_function_seconds', 'Time spent in database.py functions (including pool wait)', ['function'])
+DB_ERRORS = Counter('db_function_errors_total', 'Exceptions raised by database.py functions', ['function'])
+DB_ACQUIRE_SECONDS = Histogram('db_pool_acquire_seconds', 'Time waiting for a connection from the asyncpg pool')
+DB_ACQUIRE_WAITING = Gauge('db_pool_acquire_waiting', 'Coroutines currently waiting for a pool connection')
+TELEGRAM_SECONDS = Histogram('telegram_request_seconds', 'Bot API request latency (per attempt)', ['method', 'result'],
+                             buckets=(0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30))
+
+def instrument_module(namespace: dict, module_name: str):
+    """给模块里所有的 async 函数加上耗时和异常统计 (在模块末尾调用，from module import * 拿到的也是计时后的版本)"""
+    for name, func in list(namespace.items()):
+        if name.startswith('_') or not inspect.iscoroutinefunction(func) or func.__module__ != module_name:
+            continue
+        namespace[name] = timed(func)
+
+def timed(func):
+    name = func.__name__
+
+    @functools.wraps(func)
+    async def wrapper(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return await func(*args, **kwargs)
+        except Exception:
+            DB_ERRORS.inc(name)
+            raise
+        finally:
+            DB_SECONDS.observe(name, value=time.perf_counter() - start)
+    return wrapper
+
+class TimedPool:
+    """asyncpg 连接池的包装：记录获取连接的等待时间和排队数，其余属性直接转发"""
+
+    def __init__(self, pool):
+        self._pool = pool
+
+    def __getattr__(self, name):
+        return getattr(self._pool, name)
+
+    def acquire(self, *, timeout: float = None):
+        return TimedAcquire(self._pool, timeout)
+
+    def stats(self) -> dict:
+        size = self._pool.get_size()
+        return {
+            ('size',): size,
+            ('idle',): self._pool.get_idle_size(),
+            ('in_use',): size - self._pool.get_idle_size(),
+            ('max',): self._pool.get_max_size(),
+        }
+
+class TimedAcquire:
+    def __init__(self, pool, timeout):
+        self.pool = pool
+        self.timeout = timeout
+        self.conn = None
+
+    async def __aenter__(self):
+        DB_ACQUIRE_WAITING.inc()
+        try:
+            with DB_ACQUIRE_SECONDS.time():
+                self.conn = await self.pool.acquire(timeout=self.timeout)
+        finally:
+            DB_ACQUIRE_WAITING.dec()
+        return self.conn
+
+    async def __aexit__(self, *exc):
+        conn, self.conn = self.conn, None
+        await self.pool.release(conn)
+
+async def serve(host: str, port: int, routes=None):
+    """Bot 进程的指标服务器 (aiohttp)。routes: 额外的 {path: handler}"""
+    from aiohttp import web
+
+    async def metrics_view(request):
+        return web.Response(body=render().encode(), headers={'Content-Type': CONTENT_TYPE})
+
+    app = web.Application()
+    app.router.add_get('/metrics', metrics_view)
+    for path, handler in (routes or {}).items():
+        app.router.add_get(path, handler)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    print(f"Metrics server listening on {host}:{port}/metrics")
+    return runner
@@ -0,0 +1,152 @@
+import time
+import asyncio
+from contextlib import contextmanager
+from contextvars import ContextVar
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+from aiogram.exceptions import TelegramRetryAfter
+import metrics
+from aiogram.methods import (
+    AnswerCallbackQuery, BanChatMember, UnbanChatMember,
+    GetUpdates, GetMe, SetWebhook, DeleteWebhook, GetWebhookInfo, Close, LogOut,
+)
+from cache import TTLCache
+
+# 优先级：数字越小越优先。回调应答和封禁不能被卡片刷新挤掉
+HIGH, NORMAL, LOW = 0, 1, 2
+METHOD_PRIORITY = {
+    AnswerCallbackQuery: HIGH,
+    BanChatMember: HIGH,
+    UnbanChatMember: HIGH,
+}
+# 长轮询和 Bot 自身管理请求不参与限流
+UNTHROTTLED = (GetUpdates, GetMe, SetWebhook, DeleteWebhook, GetWebhookInfo, Close, LogOut)
+
+# 每群约 20 条/分钟的限额只针对发到群里的消息；GetChatMember、GetChat 等读取请求只受全局限额约束
+MESSAGE_METHOD_PREFIXES = ('Send', 'Edit', 'Delete', 'Copy', 'Forward')
+
+def sends_message(method) -> bool:
+    return type(method).__name__.startswith(MESSAGE_METHOD_PREFIXES)
+
+# 调用方可以用 with priority(LOW): ... 覆盖默认优先级 (例如卡片刷新)
+CURRENT_PRIORITY = ContextVar('outbound_priority', default=None)
+
+@contextmanager
+def priority(level: int):
+    token = CURRENT_PRIORITY.set(level)
+    try:
+        yield
+    finally:
+        CURRENT_PRIORITY.reset(token)
+
+class TokenBucket:
+    """令牌桶：rate 个/秒，最多积累 capacity 个；blocked_until 用于遵守 429 的 retry_after"""
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0
+
+    def delay(self, tokens_needed: bool = True) -> float:
+        """距离可以发出下一个请求还需等待的秒数"""
+        now = time.monotonic()
+        if now > self.blocked_until:
+            self.tokens = min(self.capacity, self.tokens + (now - max(self.updated, self.blocked_until)) * self.rate)
+        self.updated = now
+        wait = self.blocked_until - now
+        if tokens_needed and self.tokens < 1:
+            wait = max(wait, (1 - self.tokens) / self.rate)
+        return max(wait, 0.0)
+
+    def consume(self):
+        self.tokens -= 1
+
+    def block(self, seconds: float):
+        # 封锁期间不积累令牌，避免解除后瞬间放出一大批请求再次触发 429
+        self.delay()
+        self.tokens = min(self.tokens, 0)
+        self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+
+class OutboundScheduler(BaseRequestMiddleware):
+    """所有 Bot API 请求的出口调度：全局 + 每个群的令牌桶，按优先级放行，遇到 429 按 retry_after 重试"""
+
+    def __init__(self, global_rate: float = 30, chat_per_minute: float = 20, max_retries: int = 3):
+        self.global_bucket = TokenBucket(global_rate, global_rate)
+        self.chat_per_minute = chat_per_minute
+        self.chat_buckets = TTLCache(maxsize=10000, ttl=3600)
+        self.max_retries = max_retries
+        # 每个优先级上正在等待全局令牌的请求数
+        self.contending = [0, 0, 0]
+
+    def set_global_rate(self, rate: float):
+        # 多进程模式下每个子进程只分到全局限额的一部分
+        self.global_bucket = TokenBucket(rate, rate)
+
+    def chat_bucket(self, chat_id: int) -> TokenBucket:
+        bucket = self.chat_buckets.get(chat_id)
+        if bucket is None:
+            bucket = TokenBucket(self.chat_per_minute / 60, self.chat_per_minute)
+        self.chat_buckets.set(chat_id, bucket)
+        return bucket
+
+    async def acquire(self, chat_id, level: int):
+        # 每群限额只针对群组 (chat_id < 0)；高优先级请求只遵守该群的 429 封锁，不消耗群配额
+        bucket = self.chat_bucket(chat_id) if isinstance(chat_id, int) and chat_id < 0 else None
+        while True:
+            if bucket:
+                wait = bucket.delay(tokens_needed=level != HIGH)
+                if wait > 0:
+                    await asyncio.sleep(wait)
+                    continue
+            if not any(self.contending[:level]) and self.global_bucket.delay() <= 0:
+                self.global_bucket.consume()
+                if bucket and level != HIGH:
+                    bucket.consume()
+                return
+            self.contending[level] += 1
+            try:
+                await asyncio.sleep(max(self.global_bucket.delay(), 0.01))
+            finally:
+                self.contending[level] -= 1
+
+    async def __call__(self, make_request, bot, method):
+        if isinstance(method, UNTHROTTLED):
+            return await make_request(bot, method)
+
+        level = CURRENT_PRIORITY.get()
+        if level is None:
+            level = METHOD_PRIORITY.get(type(method), NORMAL)
+        chat_id = getattr(method, 'chat_id', None)
+        # 只有发消息的请求消耗群配额；其他请求按无群处理，只取全局令牌
+        group_id = chat_id if sends_message(method) else None
+
+        for attempt in range(self.max_retries + 1):
+            await self.acquire(group_id, level)
+            try:
+                return await make_request(bot, method)
+            except TelegramRetryAfter as e:
+                if attempt == self.max_retries:
+                    raise
+                print(f"Telegram 429 on {type(method).__name__} (chat {chat_id}), retry after {e.retry_after}s")
+                if isinstance(group_id, int) and group_id < 0:
+                    self.chat_bucket(group_id).block(e.retry_after)
+                else:
+                    self.global_bucket.block(e.retry_after)
+
+class TelegramMetrics(BaseRequestMiddleware):
+    """记录每次实际发出的 Bot API 请求耗时 (注册在调度器之后，不包含排队等待，429 重试分别计入)"""
+
+    async def __call__(self, make_request, bot, method):
+        start = time.perf_counter()
+        result = "ok"
+        try:
+            return await make_request(bot, method)
+        except TelegramRetryAfter:
+            result = "retry_after"
+            raise
+        except Exception:
+            result = "error"
+            raise
+        finally:
+            metrics.TELEGRAM_SECONDS.observe(type(method).__name__, result, value=time.perf_counter() - start)
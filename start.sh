@@ -4,25 +4,40 @@
 echo "Starting Bot Service..."
 # 将 Bot 输出重定向到 bot.log
 nohup python bot.py > bot.log 2>&1 &
+BOT_PID=$!
 
-# --- 2. 数据库就绪检查 (等待 Bot 初始化数据库) ---
-echo "Waiting for database initialization by Bot (max 30s)..."
-COUNTER=0
-MAX_ATTEMPTS=6 # 检查 6 次，每次 5 秒
+# --- 2. 就绪检查 (等待 Bot 完成数据库迁移和初始化) ---
+# 优先轮询 Bot 的 /readyz (指标端口，Webhook 多进程时由主进程在所有子进程就绪后才返回 200)；没有 curl 或关闭了指标端口时退回到检查 bot.log 中的启动标志
+echo "Waiting for Bot readiness (max 60s)..."
+READY_URL="http://127.0.0.1:${METRICS_PORT:-9101}/readyz"
 READY_FLAG="已启动" # bot.py 中成功启动的标志
+COUNTER=0
+MAX_ATTEMPTS=120 # 每 0.5 秒检查一次
+
+bot_ready() {
+    if [ "${METRICS_PORT:-9101}" != "0" ] && command -v curl > /dev/null; then
+        curl -fs -o /dev/null "$READY_URL"
+    else
+        grep -q "$READY_FLAG" bot.log
+    fi
+}
 
 while [ $COUNTER -lt $MAX_ATTEMPTS ]; do
-    if grep -q "$READY_FLAG" bot.log; then
-        echo "Database pool initialized. Bot is running."
+    if bot_ready; then
+        echo "Bot is ready after $((COUNTER / 2))s."
+        break
+    fi
+    if ! kill -0 $BOT_PID 2> /dev/null; then
+        echo "FATAL: Bot process exited during startup."
+        COUNTER=$MAX_ATTEMPTS
         break
     fi
-    echo "Waiting 5 seconds..."
-    sleep 5
+    sleep 0.5
     COUNTER=$((COUNTER + 1))
 done
 
 if [ $COUNTER -eq $MAX_ATTEMPTS ]; then
-    echo "FATAL: Bot failed to initialize database pool within 30 seconds."
+    echo "FATAL: Bot failed to become ready within 60 seconds."
     echo "请检查 bot.log 以获取具体的数据库连接或配置错误。"
     echo "--- Bot Log Tail ---"
     tail -n 20 bot.log
@@ -32,5 +47,5 @@ fi
 
 # --- 3. 启动 Web 服务 (前台) ---
 echo "Starting Web Service using Uvicorn Worker..."
-# 使用 Uvicorn Worker 启动 Gunicorn，以兼容异步 Web 路由
+# 使用 Uvicorn Worker 启动 Gunicorn，以兼容异步 Web 路由；每个 Worker 启动时预热连接池，/readyz 可用于负载均衡的就绪检查
 exec gunicorn --workers 4 --bind 0.0.0.0:$PORT --worker-class uvicorn.workers.UvicornWorker web:app
\ No newline at end of file
@@ -0,0 +1,79 @@
+"""集群共享状态：以 Postgres 表为准，每个进程保留一份本地缓存，通过 LISTEN/NOTIFY 增量同步。
+
+多个 Bot 实例或 Web Worker 并行运行时，任何一个进程的写操作都会通知到其他进程，
+不需要在每次 /add、/del 之后全量重新加载。
+"""
+import database
+
+ALLOWED_CHAT_IDS = set()
+ADMIN_IDS = set()
+# 封禁用户集合：群消息处理时本地 O(1) 检查
+BANNED_IDS = set()
+# 群组设置：chat_id -> {'min_join_days', 'force_channel_id', 'decay_half_life_days'}
+CHAT_SETTINGS = {}
+DEFAULT_CHAT_SETTINGS = {'min_join_days': 0, 'force_channel_id': 0, 'decay_half_life_days': 0}
+# 每个群当前卡片的 message_id (读穿透：未命中时查 chat_cards 表)
+LAST_CARD_MSG_ID = {}
+
+async def load():
+    """全量加载 (启动时以及监听连接重连后)。原地更新，保证其他模块持有的引用仍然有效"""
+    chats = await database.get_allowed_chats()
+    settings = await database.get_chat_settings_list()
+    banned = await database.load_banned_ids()
+    admins = await database.load_admins()
+
+    replace(ALLOWED_CHAT_IDS, {c['chat_id'] for c in chats})
+    replace(BANNED_IDS, banned)
+    replace(ADMIN_IDS, admins)
+    CHAT_SETTINGS.clear()
+    CHAT_SETTINGS.update({
+        s['chat_id']: {
+            'min_join_days': s['min_join_days'],
+            'force_channel_id': s['force_channel_id'],
+            'decay_half_life_days': s['decay_half_life_days'],
+        }
+        for s in settings
+    })
+    # 卡片位置可能在断线期间被其他实例改过，清空后按需重新读取
+    LAST_CARD_MSG_ID.clear()
+
+def replace(target: set, values: set):
+    target.intersection_update(values)
+    target.update(values)
+
+async def subscribe():
+    """订阅所有共享状态的变更通知"""
+    await database.listen(database.ALLOWED_CHATS_CHANNEL, lambda payload: apply_set_change(ALLOWED_CHAT_IDS, payload))
+    await database.listen(database.ADMINS_CHANNEL, lambda payload: apply_set_change(ADMIN_IDS, payload))
+    await database.listen(database.BANNED_CHANNEL, lambda payload: apply_set_change(BANNED_IDS, payload))
+    await database.listen(database.CHAT_SETTINGS_CHANNEL, on_chat_settings_changed)
+    await database.listen(database.CHAT_CARDS_CHANNEL, on_chat_card_changed)
+
+def apply_set_change(target: set, payload: str):
+    """NOTIFY 载荷: '+<id>' 表示加入，'-<id>' 表示移除"""
+    value = int(payload[1:])
+    if payload[0] == '+':
+        target.add(value)
+    else:
+        target.discard(value)
+
+def on_chat_settings_changed(payload: str):
+    """NOTIFY 载荷: '<chat_id>:<min_join_days>:<force_channel_id>:<decay_half_life_days>'"""
+    chat_id, min_days, channel_id, half_life = (int(x) for x in payload.split(':'))
+    CHAT_SETTINGS[chat_id] = {'min_join_days': min_days, 'force_channel_id': channel_id, 'decay_half_life_days': half_life}
+
+def on_chat_card_changed(payload: str):
+    """NOTIFY 载荷: '<chat_id>:<message_id>'"""
+    chat_id, message_id = (int(x) for x in payload.split(':'))
+    LAST_CARD_MSG_ID[chat_id] = message_id
+
+async def get_card_msg_id(chat_id: int):
+    if chat_id not in LAST_CARD_MSG_ID:
+        LAST_CARD_MSG_ID[chat_id] = await database.get_chat_card(chat_id) or None
+    return LAST_CARD_MSG_ID[chat_id]
+
+async def set_card_msg_id(chat_id: int, message_id: int):
+    """登记新卡片，返回需要删除的旧卡片"""
+    old_id = await database.swap_chat_card(chat_id, message_id)
+    LAST_CARD_MSG_ID[chat_id] = message_id
+    return old_id
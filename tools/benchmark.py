@@ -0,0 +1,153 @@
+"""离线压测：在本进程内启动假 Telegram Bot API，把合成的群消息和投票点击送进 group / vote 处理函数，
+数据库使用本地 Postgres (会写入合成数据，请使用测试库)。
+
+用法:
+    DATABASE_URL=postgresql://localhost/rating_bench python tools/benchmark.py --count 5000 --latency-ms 30
+    # 回归门槛：p99 超过 200ms 或吞吐低于 300 updates/s 时返回非零
+    python tools/benchmark.py --fail-p99-ms 200 --fail-below-rate 300
+    # 出站调度器默认按 Telegram 的 30 次/秒限速；只测 Bot 自身的处理能力时放开限速
+    TG_GLOBAL_RATE=100000 TG_CHAT_PER_MINUTE=100000 python tools/benchmark.py
+
+输出: updates/s、处理延迟 p50/p99、每个更新的数据库调用数和 Telegram 调用数。
+"""
+import os
+import sys
+import time
+import asyncio
+import argparse
+import json
+
+# 在导入 bot 之前配置环境：Bot 指向假 API，不开启指标端口
+os.environ.setdefault('BOT_TOKEN', '123456:bench')
+os.environ['METRICS_PORT'] = '0'
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from fake_telegram import FakeTelegram, start as start_fake_api
+from post_updates import generate
+
+def percentile(values, p: float) -> float:
+    values = sorted(values)
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+def metric_count(histogram) -> int:
+    return sum(data[-1] for data in histogram.values.values())
+
+async def run(args):
+    fake = FakeTelegram(args.latency_ms, args.rate_429, args.retry_after, args.max_rps)
+    runner = await start_fake_api(fake, '127.0.0.1', args.api_port)
+    os.environ['TELEGRAM_API_URL'] = f"http://127.0.0.1:{args.api_port}"
+
+    import bot
+    import database
+    import metrics
+    from webhook import ShardedDispatcher
+
+    await bot.startup(metrics_port=0)
+    chats = [-1000000000000 - i for i in range(args.chats)]
+    for chat_id in chats:
+        await database.save_group(chat_id)
+        bot.ALLOWED_CHAT_IDS.add(chat_id)
+
+    updates = list(generate(args.count, args.chats, args.users, args.vote_ratio))
+    # 预热：连接池、username 缓存等 (不计入结果)
+    warmup = list(generate(min(200, args.count), args.chats, args.users, args.vote_ratio))
+    latencies = []
+    errors = [0]
+
+    class TimedDispatcher(ShardedDispatcher):
+        async def worker(self, queue):
+            while True:
+                update = await queue.get()
+                started = time.perf_counter()
+                try:
+                    await self.dp.feed_raw_update(self.bot, update)
+                except Exception as e:
+                    errors[0] += 1
+                    print(f"Update Handling Error: {e}")
+                finally:
+                    latencies.append(time.perf_counter() - started)
+                    queue.task_done()
+
+    async def replay(batch):
+        sharder = TimedDispatcher(bot.dp, bot.bot, args.workers)
+        sharder.start()
+        for update in batch:
+            await sharder.submit(update)
+        await sharder.stop()
+        # 卡片在后台合并渲染，等它们全部发完再统计 Telegram 调用
+        while bot.CARD_WORKERS:
+            await asyncio.sleep(0.05)
+        if bot.VOTE_BUFFER:
+            await bot.VOTE_BUFFER.flush()
+
+    await replay(warmup)
+    latencies.clear()
+    fake.reset()
+    db_calls = metric_count(metrics.DB_SECONDS)
+    acquires = metric_count(metrics.DB_ACQUIRE_SECONDS)
+
+    started = time.perf_counter()
+    await replay(updates)
+    elapsed = time.perf_counter() - started
+
+    db_calls = metric_count(metrics.DB_SECONDS) - db_calls
+    acquires = metric_count(metrics.DB_ACQUIRE_SECONDS) - acquires
+    votes = sum('callback_query' in u for u in updates)
+    report = {
+        'updates': len(updates),
+        'messages': len(updates) - votes,
+        'callbacks': votes,
+        'errors': errors[0],
+        'seconds': round(elapsed, 3),
+        'updates_per_second': round(len(updates) / elapsed, 1),
+        'p50_ms': round(percentile(latencies, 0.50) * 1000, 2),
+        'p99_ms': round(percentile(latencies, 0.99) * 1000, 2),
+        'max_ms': round(max(latencies, default=0) * 1000, 2),
+        'db_calls_per_update': round(db_calls / len(updates), 2),
+        'pool_acquires_per_update': round(acquires / len(updates), 2),
+        'telegram_calls_per_update': round(fake.total_calls() / len(updates), 2),
+        'telegram_calls': fake.calls,
+        'telegram_429': fake.throttled,
+    }
+
+    await bot.shutdown()
+    await runner.cleanup()
+    await bot.bot.session.close()
+    return report
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline load test against a fake Telegram Bot API and local Postgres")
+    parser.add_argument('--count', type=int, default=2000)
+    parser.add_argument('--chats', type=int, default=20)
+    parser.add_argument('--users', type=int, default=500)
+    parser.add_argument('--vote-ratio', type=float, default=0.3)
+    parser.add_argument('--workers', type=int, default=16, help="chat-sharded worker tasks (as in webhook mode)")
+    parser.add_argument('--latency-ms', type=float, default=30, help="mean fake Bot API latency")
+    parser.add_argument('--rate-429', type=float, default=0, help="probability of a random 429")
+    parser.add_argument('--retry-after', type=int, default=1)
+    parser.add_argument('--max-rps', type=float, default=0, help="fake API returns 429 above this rate (0 = off)")
+    parser.add_argument('--api-port', type=int, default=8900)
+    parser.add_argument('--json', action='store_true', help="print the report as JSON")
+    parser.add_argument('--fail-p99-ms', type=float, default=0, help="exit 1 if p99 latency exceeds this")
+    parser.add_argument('--fail-below-rate', type=float, default=0, help="exit 1 if updates/s is below this")
+    args = parser.parse_args()
+
+    report = asyncio.run(run(args))
+    if args.json:
+        print(json.dumps(report, ensure_ascii=False))
+    else:
+        print(f"{report['updates']} updates ({report['messages']} messages, {report['callbacks']} callbacks, "
+              f"{report['errors']} errors) in {report['seconds']}s -> {report['updates_per_second']} updates/s")
+        print(f"handler latency: p50 {report['p50_ms']}ms  p99 {report['p99_ms']}ms  max {report['max_ms']}ms")
+        print(f"per update: {report['db_calls_per_update']} DB calls, {report['pool_acquires_per_update']} pool acquires, "
+              f"{report['telegram_calls_per_update']} Telegram calls ({report['telegram_429']} x 429)")
+        print(f"Telegram calls by method: {report['telegram_calls']}")
+
+    failed = (args.fail_p99_ms and report['p99_ms'] > args.fail_p99_ms) or \
+             (args.fail_below_rate and report['updates_per_second'] < args.fail_below_rate)
+    sys.exit(1 if failed else 0)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,138 @@
+"""本地假 Telegram Bot API：记录调用次数，模拟网络延迟和 429 限流，用于离线压测。
+
+用法:
+    python tools/fake_telegram.py --port 8900 --latency-ms 40 --rate-429 0.01
+    TELEGRAM_API_URL=http://127.0.0.1:8900 BOT_MODE=webhook python bot.py
+    curl http://127.0.0.1:8900/stats      # 各方法的调用次数
+"""
+import time
+import random
+import asyncio
+import argparse
+import json
+from aiohttp import web
+
+BOT_USER = {'id': 1, 'is_bot': True, 'first_name': 'FakeBot', 'username': 'fake_bot'}
+
+class FakeTelegram:
+    """latency_ms: 平均响应延迟 (±50% 抖动)；rate_429: 随机返回 429 的概率；
+    max_rps: 每秒请求数超过该值时返回 429 (0 表示不限)"""
+
+    def __init__(self, latency_ms: float = 0, rate_429: float = 0, retry_after: int = 1, max_rps: float = 0):
+        self.latency = latency_ms / 1000
+        self.rate_429 = rate_429
+        self.retry_after = retry_after
+        self.max_rps = max_rps
+        self.calls = {}
+        self.throttled = 0
+        self.next_message_id = 1
+        self.window = (0, 0)  # (秒, 该秒内的请求数)
+
+    def reset(self):
+        self.calls.clear()
+        self.throttled = 0
+
+    def total_calls(self) -> int:
+        return sum(self.calls.values())
+
+    def should_throttle(self) -> bool:
+        if self.rate_429 and random.random() < self.rate_429:
+            return True
+        if self.max_rps:
+            second = int(time.monotonic())
+            start, count = self.window
+            count = count + 1 if start == second else 1
+            self.window = (second, count)
+            return count > self.max_rps
+        return False
+
+    def message(self, chat_id, text: str, message_id: int = None) -> dict:
+        if message_id is None:
+            message_id, self.next_message_id = self.next_message_id, self.next_message_id + 1
+        return {
+            'message_id': message_id,
+            'date': int(time.time()),
+            'chat': {'id': int(chat_id), 'type': 'supergroup', 'title': f'group {chat_id}'},
+            'from': BOT_USER,
+            'text': text or '',
+        }
+
+    def result(self, method: str, params: dict):
+        if method == 'getMe':
+            return BOT_USER
+        if method == 'sendMessage':
+            return self.message(params['chat_id'], params.get('text'))
+        if method == 'editMessageText':
+            return self.message(params['chat_id'], params.get('text'), int(params['message_id']))
+        if method == 'getChat':
+            chat = str(params['chat_id'])
+            if chat.lstrip('-').isdigit():
+                return {'id': int(chat), 'type': 'supergroup', 'title': f'group {chat}'}
+            # 合成用户的 username 以数字结尾 (user123)，据此还原 user_id
+            name = chat.lstrip('@')
+            digits = ''.join(c for c in name if c.isdigit())
+            return {'id': int(digits or 0) or abs(hash(name)) % 10 ** 9, 'type': 'private', 'username': name, 'first_name': name}
+        if method == 'getChatMember':
+            user_id = int(params['user_id'])
+            return {'status': 'member', 'user': {'id': user_id, 'is_bot': False, 'first_name': f'u{user_id}'}}
+        if method == 'getUpdates':
+            return []
+        return True
+
+    async def handle(self, request: web.Request):
+        method = request.match_info['method']
+        self.calls[method] = self.calls.get(method, 0) + 1
+        params = dict(await request.post())
+        if self.latency:
+            await asyncio.sleep(self.latency * random.uniform(0.5, 1.5))
+        if self.should_throttle():
+            self.throttled += 1
+            return web.json_response({
+                'ok': False, 'error_code': 429,
+                'description': f'Too Many Requests: retry after {self.retry_after}',
+                'parameters': {'retry_after': self.retry_after},
+            })
+        return web.json_response({'ok': True, 'result': self.result(method, params)})
+
+    async def stats(self, request: web.Request):
+        return web.json_response({'calls': self.calls, 'throttled': self.throttled})
+
+    def app(self) -> web.Application:
+        app = web.Application()
+        app.router.add_post('/bot{token}/{method}', self.handle)
+        app.router.add_get('/stats', self.stats)
+        return app
+
+async def start(fake: FakeTelegram, host: str = '127.0.0.1', port: int = 8900) -> web.AppRunner:
+    runner = web.AppRunner(fake.app(), access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    return runner
+
+def main():
+    parser = argparse.ArgumentParser(description="Fake Telegram Bot API server for offline load tests")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8900)
+    parser.add_argument('--latency-ms', type=float, default=30)
+    parser.add_argument('--rate-429', type=float, default=0)
+    parser.add_argument('--retry-after', type=int, default=1)
+    parser.add_argument('--max-rps', type=float, default=0)
+    args = parser.parse_args()
+
+    fake = FakeTelegram(args.latency_ms, args.rate_429, args.retry_after, args.max_rps)
+
+    async def run():
+        await start(fake, args.host, args.port)
+        print(f"Fake Telegram Bot API on http://{args.host}:{args.port} (latency {args.latency_ms}ms, 429 rate {args.rate_429})")
+        try:
+            await asyncio.Event().wait()
+        finally:
+            print(json.dumps({'calls': fake.calls, 'throttled': fake.throttled}))
+
+    try:
+        asyncio.run(run())
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == "__main__":
+    main()
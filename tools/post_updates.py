@@ -0,0 +1,96 @@
+"""本地假推送：向 Webhook 模式的 Bot POST 合成的 Telegram 更新，用于测试和压测。
+
+用法:
+    BOT_MODE=webhook python bot.py
+    python tools/post_updates.py --url http://127.0.0.1:8081/webhook --chats 20 --count 2000
+"""
+import time
+import random
+import asyncio
+import argparse
+import aiohttp
+
+def make_message(update_id: int, chat_id: int, user_id: int, text: str) -> dict:
+    return {
+        'update_id': update_id,
+        'message': {
+            'message_id': update_id,
+            'date': int(time.time()),
+            'chat': {'id': chat_id, 'type': 'supergroup', 'title': f'group {chat_id}'},
+            'from': {'id': user_id, 'is_bot': False, 'first_name': f'u{user_id}', 'username': f'user{user_id}'},
+            'text': text,
+        },
+    }
+
+def make_callback(update_id: int, chat_id: int, user_id: int, target_id: int, card_msg_id: int, evidence_msg_id: int) -> dict:
+    return {
+        'update_id': update_id,
+        'callback_query': {
+            'id': str(update_id),
+            'from': {'id': user_id, 'is_bot': False, 'first_name': f'u{user_id}', 'username': f'user{user_id}'},
+            'chat_instance': str(chat_id),
+            # 合成 username 不含下划线：回调数据以 '_' 分隔
+            'data': f"{random.choice(['rec', 'black'])}_{target_id}_user{target_id}",
+            'message': {
+                'message_id': card_msg_id,
+                'date': int(time.time()),
+                'chat': {'id': chat_id, 'type': 'supergroup', 'title': f'group {chat_id}'},
+                'from': {'id': 1, 'is_bot': True, 'first_name': 'bot'},
+                'text': 'card',
+                'reply_to_message': {
+                    'message_id': evidence_msg_id,
+                    'date': int(time.time()),
+                    'chat': {'id': chat_id, 'type': 'supergroup', 'title': f'group {chat_id}'},
+                    'text': 'evidence',
+                },
+            },
+        },
+    }
+
+def generate(count: int, chats: int, users: int, vote_ratio: float):
+    """合成更新流：群消息提及随机用户，按比例夹杂投票按钮点击"""
+    for update_id in range(1, count + 1):
+        chat_id = -1000000000000 - random.randrange(chats)
+        user_id = random.randrange(1, users + 1)
+        target_id = random.randrange(1, users + 1)
+        if random.random() < vote_ratio:
+            yield make_callback(update_id, chat_id, user_id, target_id, update_id, max(1, update_id - 1))
+        else:
+            yield make_message(update_id, chat_id, user_id, f"@user{target_id} 靠谱吗")
+
+async def post_all(url: str, secret: str, updates, concurrency: int):
+    headers = {'X-Telegram-Bot-Api-Secret-Token': secret} if secret else {}
+    statuses = {}
+    queue = asyncio.Queue()
+    for update in updates:
+        queue.put_nowait(update)
+
+    async def sender(session):
+        while not queue.empty():
+            update = queue.get_nowait()
+            async with session.post(url, json=update, headers=headers) as resp:
+                statuses[resp.status] = statuses.get(resp.status, 0) + 1
+
+    async with aiohttp.ClientSession() as session:
+        await asyncio.gather(*(sender(session) for _ in range(concurrency)))
+    return statuses
+
+def main():
+    parser = argparse.ArgumentParser(description="POST synthetic Telegram updates to a local webhook")
+    parser.add_argument('--url', default='http://127.0.0.1:8081/webhook')
+    parser.add_argument('--secret', default=None)
+    parser.add_argument('--count', type=int, default=1000)
+    parser.add_argument('--chats', type=int, default=10)
+    parser.add_argument('--users', type=int, default=200)
+    parser.add_argument('--vote-ratio', type=float, default=0.3)
+    parser.add_argument('--concurrency', type=int, default=20)
+    args = parser.parse_args()
+
+    updates = list(generate(args.count, args.chats, args.users, args.vote_ratio))
+    started = time.perf_counter()
+    statuses = asyncio.run(post_all(args.url, args.secret, updates, args.concurrency))
+    elapsed = time.perf_counter() - started
+    print(f"posted {len(updates)} updates in {elapsed:.2f}s ({len(updates) / elapsed:.0f}/s), statuses: {statuses}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,177 @@
+"""投票写缓冲 (VOTE_WRITE_BEHIND=1 时启用)：投票先进入内存队列，由后台任务按批写入数据库。
+
+持久性约定：
+- 用户看到“投票成功”时，投票只保证在本进程内存中，最多 flush_interval 秒后 (或攒满 batch_size 条时) 落盘；
+- 正常退出 (close) 会把队列全部写完；进程崩溃或被 kill -9 时，尚未落盘的投票会丢失；
+- 写入失败时整批保留在队列中并退避重试，不会丢弃；队列达到 max_pending 时新的投票等待落盘 (背压)。
+
+投票返回的分数不逐票查询数据库：每个 (群, 被投票人) 的已落盘分数在内存中缓存 BASE_TTL 秒，
+本进程的投票落盘时把增量直接加到缓存上，返回值 = 缓存 + 尚未落盘的增量。
+每个 (群, 被投票人) 在 BASE_TTL 内只读一次数据库，与点击次数无关。
+
+24h 冷却在内存中检查，启动时从 votes 表载入最近一天的投票。同一个群的投票必须由同一个进程处理
+(单进程，或 Webhook 按 chat_id 分片)，否则不同进程之间的冷却互不可见；数据库端的冷却检查仍会兜底，
+重复票不会被计数，只是用户会先看到“投票成功”。
+"""
+import time
+import asyncio
+import database
+
+COOLDOWN = 24 * 3600
+# 清理过期冷却记录的间隔
+EXPIRE_INTERVAL = 60
+# 已落盘分数的缓存时间 (其他实例的投票在此之后可见)
+BASE_TTL = 30
+
+class VoteBuffer:
+    """内存冷却检查 + 批量落盘。返回的分数包含尚未落盘的投票，落盘前为近似值"""
+
+    def __init__(self, flush_interval: float = 0.5, batch_size: int = 500, max_pending: int = 10000):
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+        self.max_pending = max_pending
+        self.queue = []
+        # (chat_id, voter_id, target_id, type) -> 最近一次投票的 unix 时间
+        self.last_vote = {}
+        # 已接受但尚未落盘的增量：user_id -> [rec, black]，(chat_id, user_id) -> [rec, black, score]
+        self.pending = {}
+        # 已落盘的分数：target_id -> {(chat_id, half_life_days): ([rec, black, chat_rec, chat_black, chat_score], 过期时间)}
+        self.base = {}
+        self.wakeup = asyncio.Event()
+        self.drained = asyncio.Event()
+        self.lock = asyncio.Lock()
+        self.task = None
+        self.next_expire = 0.0
+
+    async def start(self):
+        now = time.time()
+        for chat_id, voter_id, target_id, typ, ts in await database.load_recent_votes():
+            if now - ts < COOLDOWN:
+                self.last_vote[(chat_id, voter_id, target_id, typ)] = ts
+        self.task = asyncio.create_task(self.run())
+
+    async def add(self, chat_id: int, voter_id: int, target_id: int, typ: str, username: str,
+                  evidence_msg_id: int = None, half_life_days: int = 0):
+        """与 database.add_vote 相同的参数和返回值；返回的总数 = 数据库中的值 + 尚未落盘的增量"""
+        key = (chat_id, voter_id, target_id, typ)
+        now = time.time()
+        if now - self.last_vote.get(key, 0) < COOLDOWN:
+            return None
+        # 冷却登记在任何 await 之前完成，同一个人的并发点击只有一次通过
+        self.last_vote[key] = now
+        while len(self.queue) >= self.max_pending:
+            self.wakeup.set()
+            self.drained.clear()
+            await self.drained.wait()
+
+        row = (chat_id, voter_id, target_id, typ, username, evidence_msg_id, half_life_days)
+        self.queue.append(row)
+        self.bump(row, 1)
+        if len(self.queue) >= self.batch_size:
+            self.wakeup.set()
+
+        r, b, local_r, local_b, local_score = await self.base_stats(chat_id, target_id, half_life_days)
+        pr, pb = self.pending.get(target_id, (0, 0))
+        plr, plb, pls = self.pending.get((chat_id, target_id), (0, 0, 0))
+        return r + pr, b + pb, local_r + plr, local_b + plb, local_score + pls
+
+    async def base_stats(self, chat_id: int, target_id: int, half_life_days: int):
+        """已落盘的 (rec, black, chat_rec, chat_black, chat_score)，优先取内存缓存。
+        读取与 flush 互斥：否则可能读到刚写入、但还没从 pending 中扣除的投票，重复计数"""
+        key = (chat_id, half_life_days)
+        entry = self.base.get(target_id, {}).get(key)
+        if entry and entry[1] > time.monotonic():
+            return tuple(entry[0])
+        async with self.lock:
+            entry = self.base.get(target_id, {}).get(key)
+            if entry and entry[1] > time.monotonic():
+                return tuple(entry[0])
+            stats = await database.get_card_stats(chat_id, target_id, half_life_days)
+            self.base.setdefault(target_id, {})[key] = (list(stats), time.monotonic() + BASE_TTL)
+            return stats
+
+    def apply_to_base(self, row):
+        """一票已落盘：加到该被投票人的所有缓存分数上 (全局分数对每个群都加，本群分数只加到同一个群)"""
+        chat_id, _, target_id, typ = row[:4]
+        is_rec = typ == "rec"
+        for (cached_chat, _), (stats, _) in self.base.get(target_id, {}).items():
+            stats[0 if is_rec else 1] += 1
+            if cached_chat == chat_id:
+                stats[2 if is_rec else 3] += 1
+                stats[4] += 1 if is_rec else -1
+
+    def forget(self, target_id: int):
+        """该用户的分数在数据库中被直接修改 (如 /clearuser) 后调用，下一次投票重新读取"""
+        self.base.pop(target_id, None)
+
+    def bump(self, row, sign: int):
+        chat_id, _, target_id, typ = row[:4]
+        is_rec = typ == "rec"
+        totals = self.pending.setdefault(target_id, [0, 0])
+        totals[0 if is_rec else 1] += sign
+        local = self.pending.setdefault((chat_id, target_id), [0, 0, 0])
+        local[0 if is_rec else 1] += sign
+        local[2] += sign if is_rec else -sign
+        if not any(totals):
+            del self.pending[target_id]
+        if not any(local):
+            del self.pending[(chat_id, target_id)]
+
+    async def run(self):
+        backoff = 1
+        while True:
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self.wakeup.clear()
+            try:
+                await self.flush()
+                backoff = 1
+            except Exception as e:
+                print(f"Vote Flush Error ({len(self.queue)} pending): {e}")
+                await asyncio.sleep(backoff)
+                backoff = min(backoff * 2, 30)
+            self.expire()
+
+    async def flush(self):
+        """把队列中的投票全部写入数据库；失败时未写入的批次留在队首。
+        每批单独加锁：持续有新投票时，等待读取已落盘分数的投票可以在批次之间插入，不会等到队列清空"""
+        while self.queue:
+            async with self.lock:
+                if not self.queue:
+                    break
+                batch = self.queue[:self.batch_size]
+                await database.add_votes(batch)
+                del self.queue[:len(batch)]
+                for row in batch:
+                    self.bump(row, -1)
+                    self.apply_to_base(row)
+                self.drained.set()
+
+    def expire(self):
+        if time.monotonic() < self.next_expire:
+            return
+        self.next_expire = time.monotonic() + EXPIRE_INTERVAL
+        cutoff = time.time() - COOLDOWN
+        for key in [k for k, ts in self.last_vote.items() if ts < cutoff]:
+            del self.last_vote[key]
+        now = time.monotonic()
+        for target_id in [t for t, entries in self.base.items() if all(exp <= now for _, exp in entries.values())]:
+            del self.base[target_id]
+
+    async def close(self, attempts: int = 3):
+        """停止后台任务并把剩余的投票全部落盘 (失败时短暂退避重试，最后一次的异常照常抛出)"""
+        if self.task:
+            self.task.cancel()
+            await asyncio.gather(self.task, return_exceptions=True)
+            self.task = None
+        for attempt in range(attempts):
+            try:
+                await self.flush()
+                return
+            except Exception as e:
+                if attempt == attempts - 1:
+                    raise
+                print(f"Vote Flush Error on close ({len(self.queue)} pending), retrying: {e}")
+                await asyncio.sleep(attempt + 1)
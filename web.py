@@ -1,8 +1,21 @@
 import os
+import io
+import csv
+import json
+import hashlib
 import asyncio
-from flask import Flask, jsonify, request, render_template_string
-from asgiref.wsgi import WsgiToAsgi
-from database import get_banned_list, unban_user, get_total_users, get_total_votes, get_chat_settings_list, db_pool, init_db_pool
+from datetime import datetime, timedelta, timezone
+from quart import Quart, Response, jsonify, request
+from markupsafe import escape
+import database
+from database import get_banned_page, iter_banned_users, unban_user, get_total_users, get_total_votes, init_db_pool, close_db_pool
+from database import get_chat_settings_page, iter_chat_settings
+from database import lookup_username, create_ban_job, get_ban_job
+from database import warm_up_pool, get_schema_version, SCHEMA_VERSION
+from database import get_user_profile, get_user_votes, evidence_link, search_users
+import leaderboard
+import metrics
+from cache import TTLCache, SingleFlight
 
 # --- 配置 ---
 
@@ -18,7 +31,9 @@ print("-" * 50)
 # --- DEBUG 结束 ---
 
 
-app = Flask(__name__)
+# Quart 是 Flask 的原生异步版本：路由直接运行在 Uvicorn Worker 的事件循环上，
+# 每个 Worker 进程只有一个长期存活的事件循环和一个共享的 asyncpg 连接池。
+app = Quart(__name__)
 
 # 用于 Web 页面身份验证 (非常简陋，生产环境应使用更安全的机制)
 WEB_SECRET_KEY = os.environ.get('WEB_SECRET_KEY') or "default_secret"
@@ -40,30 +55,129 @@ def is_authorized(auth_header):
         pass
     return False
 
-# Flask 视图需要同步函数。
-def sync_call(coro):
-    """同步地运行异步协程，并确保数据库连接池已初始化"""
-    global db_pool
-    # 确保 Web Worker 中的数据库连接池被初始化
-    if not db_pool:
+def get_limit(default: int = 50, maximum: int = 500):
+    try:
+        return max(1, min(int(request.args.get('limit', default)), maximum))
+    except ValueError:
+        return default
+
+def banned_json(user):
+    return {
+        "user_id": user['user_id'], 
+        "username": user['username'], 
+        "time": user['time'].isoformat() if user['time'] else None
+    }
+
+EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+
+def encode_cursor(time, row_id: int) -> str:
+    """分页游标: <距 EPOCH 的微秒数>_<id>，只含数字、'-' 和 '_'，放进 URL 无需转义；time 为空时微秒部分留空"""
+    micros = '' if time is None else (time - EPOCH) // timedelta(microseconds=1)
+    return f"{micros}_{row_id}"
+
+def parse_bigint(value: str) -> int:
+    """解析 BIGINT 范围内的整数，格式不对或越界时抛出 ValueError"""
+    number = int(value)
+    if not -2**63 <= number < 2**63:
+        raise ValueError("integer out of BIGINT range")
+    return number
+
+def decode_cursor(cursor: str):
+    """encode_cursor 的逆操作，返回 (time, id)；格式不对时抛出 ValueError"""
+    micros, row_id = cursor.split('_')
+    row_id = parse_bigint(row_id)
+    try:
+        return (EPOCH + timedelta(microseconds=int(micros)) if micros else None, row_id)
+    except OverflowError as e:
+        raise ValueError(str(e))
+
+def banned_page_json(banned_users, limit: int) -> dict:
+    next_cursor = None
+    if len(banned_users) == limit:
+        last = banned_users[-1]
+        next_cursor = encode_cursor(last['time'], last['user_id'])
+    return {"items": [banned_json(user) for user in banned_users], "next_cursor": next_cursor}
+
+def chat_settings_page_json(settings_list, limit: int) -> dict:
+    next_cursor = str(settings_list[-1]['chat_id']) if len(settings_list) == limit else None
+    return {"items": [dict(s) for s in settings_list], "next_cursor": next_cursor}
+
+def stream_export(rows, fields, to_json, filename):
+    """把异步行迭代器逐行输出为 NDJSON (默认) 或 CSV，服务端不缓存整张表"""
+    if request.args.get('format') == 'csv':
+        async def body():
+            buf = io.StringIO()
+            writer = csv.writer(buf)
+            writer.writerow(fields)
+            async for row in rows:
+                item = to_json(row)
+                writer.writerow([item[f] for f in fields])
+                yield buf.getvalue()
+                buf.seek(0)
+                buf.truncate()
+        return Response(body(), mimetype='text/csv',
+                        headers={'Content-Disposition': f'attachment; filename={filename}.csv'})
+
+    async def body():
+        async for row in rows:
+            yield json.dumps(to_json(row), ensure_ascii=False) + "\n"
+    return Response(body(), mimetype='application/x-ndjson')
+
+# --- Worker 生命周期 ---
+
+@app.before_serving
+async def startup():
+    """Worker 启动时在其事件循环上创建并预热连接池"""
+    try:
+        await init_db_pool()
+        await warm_up_pool()
+    except Exception as e:
+        # 不中止 Worker：首页会返回 503，API 会在下次请求时重试初始化
+        print(f"WEB FATAL ERROR: Database connection failed during startup: {e}")
+
+@app.after_serving
+async def shutdown():
+    await close_db_pool()
+
+async def ensure_db_pool():
+    """确保当前 Worker 的数据库连接池已初始化"""
+    if not database.db_pool:
         try:
-            asyncio.run(init_db_pool())
+            await init_db_pool()
         except Exception as e:
             # 如果 Web Worker 连接失败，打印错误并重新抛出，以便 Web Logs 捕获
-            print(f"WEB FATAL ERROR: Database connection failed during sync_call: {e}")
+            print(f"WEB FATAL ERROR: Database connection failed: {e}")
             raise RuntimeError("Database connection failed for Web Worker.") from e
-            
-    return asyncio.run(coro)
 
 # --- Web 路由 (省略，与之前一致) ---
 
+@app.route('/healthz', methods=['GET'])
+async def healthz():
+    """存活检查：Worker 在运行即返回 200，不访问数据库"""
+    return Response("ok", content_type="text/plain")
+
+@app.route('/readyz', methods=['GET'])
+async def readyz():
+    """就绪检查：连接池可用且数据库结构已迁移到最新版本 (迁移由 Bot 进程执行) 时返回 200"""
+    try:
+        await ensure_db_pool()
+        version = await get_schema_version()
+    except Exception as e:
+        return Response(f"database unavailable: {e}", status=503, content_type="text/plain")
+    if version < SCHEMA_VERSION:
+        return Response(f"schema version {version} < {SCHEMA_VERSION}", status=503, content_type="text/plain")
+    return Response("ready", content_type="text/plain")
+
 @app.route('/api/stats', methods=['GET'])
-def stats_api():
+async def stats_api():
     if not is_authorized(request.headers.get('Authorization')):
         return jsonify({"error": "Unauthorized"}), 401
     try:
-        total_users = sync_call(get_total_users())
-        total_votes = sync_call(get_total_votes())
+        await ensure_db_pool()
+        # ?estimate=1 使用 Postgres 统计信息给出近似值，完全不读计数器
+        estimate = request.args.get('estimate') in ('1', 'true')
+        total_users = await get_total_users(estimate)
+        total_votes = await get_total_votes(estimate)
         return jsonify({
             "total_users": total_users,
             "total_votes": total_votes
@@ -72,43 +186,260 @@ def stats_api():
         return jsonify({"error": str(e)}), 500
 
 @app.route('/api/banned', methods=['GET'])
-def banned_api():
+async def banned_api():
+    """分页: ?limit=50&cursor=<上一页返回的 next_cursor>"""
     if not is_authorized(request.headers.get('Authorization')):
         return jsonify({"error": "Unauthorized"}), 401
     try:
-        banned_users = sync_call(get_banned_list())
-        data = [
-            {
-                "user_id": user['user_id'], 
-                "username": user['username'], 
-                "time": user['time'].isoformat() if user['time'] else None
-            } 
-            for user in banned_users
-        ]
-        return jsonify(data)
+        await ensure_db_pool()
+        limit = get_limit()
+        after = None
+        if request.args.get('cursor'):
+            try:
+                after = decode_cursor(request.args['cursor'])
+            except ValueError:
+                return jsonify({"error": "Invalid cursor"}), 400
+        return jsonify(banned_page_json(await get_banned_page(limit, after), limit))
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
+@app.route('/api/banned/export', methods=['GET'])
+async def banned_export_api():
+    """全部封禁用户，?format=ndjson (默认) 或 csv。支持 ?key= 认证，便于直接下载"""
+    if not (is_authorized(request.headers.get('Authorization')) or request.args.get('key') == WEB_SECRET_KEY):
+        return jsonify({"error": "Unauthorized"}), 401
+    await ensure_db_pool()
+    return stream_export(iter_banned_users(), ["user_id", "username", "time"], banned_json, "banned_users")
+
 @app.route('/api/unban/<int:user_id>', methods=['POST'])
-def unban_api(user_id):
+async def unban_api(user_id):
     if not is_authorized(request.headers.get('Authorization')):
         return jsonify({"error": "Unauthorized"}), 401
     try:
-        sync_call(unban_user(user_id))
+        await ensure_db_pool()
+        await unban_user(user_id)
+        DASHBOARD_CACHE.clear()
         return jsonify({"status": "success", "user_id": user_id})
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
+@app.route('/api/ban', methods=['POST'])
+async def ban_api():
+    """批量封禁：{"users": ["@name", 123456, ...]}。踢出由 Bot 进程收到通知后异步执行"""
+    if not is_authorized(request.headers.get('Authorization')):
+        return jsonify({"error": "Unauthorized"}), 401
+    try:
+        await ensure_db_pool()
+        body = await request.get_json(silent=True) or {}
+        users, unresolved = [], []
+        for item in body.get('users') or []:
+            name = str(item).strip().lstrip('@').lower()
+            if name.isdigit():
+                users.append((int(name), None))
+                continue
+            # Web 进程没有 Bot，只能通过 Bot 见过的 username 解析
+            user_id = await lookup_username(name) if name else None
+            if user_id:
+                users.append((user_id, name))
+            else:
+                unresolved.append(item)
+        if not users:
+            return jsonify({"error": "No resolvable users", "unresolved": unresolved}), 400
+
+        job_id, total = await create_ban_job(users)
+        DASHBOARD_CACHE.clear()
+        return jsonify({
+            "status": "queued",
+            "job_id": job_id,
+            "user_ids": list(dict(users)),
+            "tasks": total,
+            "unresolved": unresolved
+        })
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+@app.route('/api/ban_jobs/<int:job_id>', methods=['GET'])
+async def ban_job_api(job_id):
+    if not is_authorized(request.headers.get('Authorization')):
+        return jsonify({"error": "Unauthorized"}), 401
+    try:
+        await ensure_db_pool()
+        job = await get_ban_job(job_id)
+        if not job:
+            return jsonify({"error": "Not found"}), 404
+        return jsonify({
+            "job_id": job['job_id'],
+            "total": job['total'],
+            "done": job['done'],
+            "failed": job['failed'],
+            "created_at": job['created_at'].isoformat(),
+            "finished_at": job['finished_at'].isoformat() if job['finished_at'] else None
+        })
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
 @app.route('/api/chat_settings', methods=['GET'])
-def chat_settings_api():
+async def chat_settings_api():
+    """分页: ?limit=50&cursor=<上一页最后的 chat_id>"""
     if not is_authorized(request.headers.get('Authorization')):
         return jsonify({"error": "Unauthorized"}), 401
     try:
-        settings_list = sync_call(get_chat_settings_list())
-        return jsonify(list(settings_list))
+        await ensure_db_pool()
+        limit = get_limit()
+        after = None
+        if request.args.get('cursor'):
+            try:
+                after = parse_bigint(request.args['cursor'])
+            except ValueError:
+                return jsonify({"error": "Invalid cursor"}), 400
+        settings_list = await get_chat_settings_page(limit, after)
+        return jsonify(chat_settings_page_json(settings_list, limit))
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
+@app.route('/api/chat_settings/export', methods=['GET'])
+async def chat_settings_export_api():
+    if not (is_authorized(request.headers.get('Authorization')) or request.args.get('key') == WEB_SECRET_KEY):
+        return jsonify({"error": "Unauthorized"}), 401
+    await ensure_db_pool()
+    return stream_export(iter_chat_settings(), ["chat_id", "min_join_days", "force_channel_id", "decay_half_life_days"], dict, "chat_settings")
+
+@app.route('/api/leaderboard', methods=['GET'])
+async def leaderboard_api():
+    """净分排行: ?chat_id=<群> 为群内排行，省略为全局；?limit=N (最多 leaderboard.TOP_SIZE)"""
+    if not is_authorized(request.headers.get('Authorization')):
+        return jsonify({"error": "Unauthorized"}), 401
+    try:
+        await ensure_db_pool()
+        limit = get_limit(default=leaderboard.TOP_SIZE, maximum=leaderboard.TOP_SIZE)
+        chat_id = request.args.get('chat_id')
+        top, bottom = await leaderboard.get_leaderboard(int(chat_id) if chat_id else None)
+        return jsonify({"chat_id": int(chat_id) if chat_id else None, "top": top[:limit], "bottom": bottom[:limit]})
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+def vote_json(vote):
+    return {
+        "id": vote['id'],
+        "time": vote['time'].isoformat(),
+        "chat_id": vote['chat_id'],
+        "voter_id": vote['voter_id'],
+        "target_id": vote['target_id'],
+        "type": vote['type'],
+        "username": vote['username'],
+        "evidence_msg_id": vote['evidence_msg_id'],
+        "evidence_link": evidence_link(vote['chat_id'], vote['evidence_msg_id']),
+    }
+
+@app.route('/api/user/<int:user_id>', methods=['GET'])
+async def user_api(user_id):
+    """用户概况、各群分数和投票记录。?direction=received (默认，收到的票) 或 cast (投出的票)；
+    分页: ?limit=20&cursor=<上一页返回的 next_cursor>，翻页时不再返回概况"""
+    if not is_authorized(request.headers.get('Authorization')):
+        return jsonify({"error": "Unauthorized"}), 401
+    direction = request.args.get('direction', 'received')
+    if direction not in ('received', 'cast'):
+        return jsonify({"error": "direction must be received or cast"}), 400
+    try:
+        await ensure_db_pool()
+        limit = get_limit(default=20, maximum=200)
+        before = None
+        if request.args.get('cursor'):
+            try:
+                before = decode_cursor(request.args['cursor'])
+                if before[0] is None:  # 投票时间不会为空
+                    raise ValueError("cursor without time")
+            except ValueError:
+                return jsonify({"error": "Invalid cursor"}), 400
+        votes = await get_user_votes(user_id, direction, limit, before)
+        next_cursor = None
+        if len(votes) == limit:
+            last = votes[-1]
+            next_cursor = encode_cursor(last['time'], last['id'])
+        result = {"user_id": user_id, "direction": direction,
+                  "votes": [vote_json(vote) for vote in votes], "next_cursor": next_cursor}
+        if before is None:
+            profile, chats = await get_user_profile(user_id)
+            result.update({
+                "username": profile['username'], "rec": profile['rec'], "black": profile['black'],
+                "net": profile['rec'] - profile['black'], "banned": profile['banned'],
+                "chats": [{"chat_id": c['chat_id'], "rec": c['rec'], "black": c['black'], "net": c['net'],
+                           "score": round(c['score'], 2), "half_life_days": c['half_life_days']} for c in chats],
+            })
+        return jsonify(result)
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+@app.route('/api/search', methods=['GET'])
+async def search_api():
+    """按 username 前缀 / 模糊搜索有分数的用户和被封禁的用户：?q=<关键词>&limit=20"""
+    if not is_authorized(request.headers.get('Authorization')):
+        return jsonify({"error": "Unauthorized"}), 401
+    try:
+        await ensure_db_pool()
+        limit = get_limit(default=20, maximum=50)
+        results = await search_users(request.args.get('q', ''), limit)
+        return jsonify({"items": [{
+            "user_id": row['user_id'], "username": row['username'], "rec": row['rec'], "black": row['black'],
+            "net": row['rec'] - row['black'], "banned": row['banned'], "match": match,
+        } for row, match in results]})
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+# --- 管理面板快照 ---
+# 统计数字 + 封禁列表和群组设置的第一页，整体缓存 DASHBOARD_CACHE_TTL 秒 (每个 Worker 一份)。
+# 缓存期内所有请求共用同一份 JSON，过期后并发请求只重建一次；内容没变时 ETag 不变，轮询返回 304
+DASHBOARD_TTL = float(os.environ.get('DASHBOARD_CACHE_TTL', '5'))
+DASHBOARD_PAGE_SIZE = 50
+DASHBOARD_CACHE = TTLCache(maxsize=1, ttl=DASHBOARD_TTL)
+DASHBOARD_BUILDS = SingleFlight()
+
+def make_etag(body: bytes) -> str:
+    return hashlib.sha1(body).hexdigest()[:20]
+
+async def build_dashboard_snapshot():
+    """返回 (JSON 字节, ETag)"""
+    total_users, total_votes, banned_users, settings_list = await asyncio.gather(
+        get_total_users(), get_total_votes(),
+        get_banned_page(DASHBOARD_PAGE_SIZE), get_chat_settings_page(DASHBOARD_PAGE_SIZE))
+    body = json.dumps({
+        "stats": {"total_users": total_users, "total_votes": total_votes},
+        "banned": banned_page_json(banned_users, DASHBOARD_PAGE_SIZE),
+        "chat_settings": chat_settings_page_json(settings_list, DASHBOARD_PAGE_SIZE),
+    }, ensure_ascii=False, separators=(',', ':')).encode()
+    snapshot = (body, make_etag(body))
+    DASHBOARD_CACHE.set('snapshot', snapshot)
+    return snapshot
+
+def conditional_response(body: bytes, etag: str, content_type: str, max_age: float = 0):
+    """带 ETag 的响应；请求的 If-None-Match 匹配时返回 304，不发送正文"""
+    headers = {'ETag': f'"{etag}"', 'Cache-Control': f"private, max-age={int(max_age)}"}
+    if request.if_none_match.contains_weak(etag):
+        return Response("", status=304, headers=headers)
+    return Response(body, content_type=content_type, headers=headers)
+
+@app.route('/api/dashboard', methods=['GET'])
+async def dashboard_api():
+    """管理面板首屏数据 (统计 + 两个列表的第一页)，支持 If-None-Match"""
+    if not is_authorized(request.headers.get('Authorization')):
+        return jsonify({"error": "Unauthorized"}), 401
+    try:
+        snapshot = DASHBOARD_CACHE.get('snapshot')
+        if snapshot is None:
+            await ensure_db_pool()
+            snapshot = await DASHBOARD_BUILDS.do(None, build_dashboard_snapshot)
+        body, etag = snapshot
+        return conditional_response(body, etag, "application/json", DASHBOARD_TTL)
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+@app.route('/metrics', methods=['GET'])
+async def metrics_api():
+    """Prometheus 指标 (本 Worker 进程)。抓取时配置 Authorization: Bearer <WEB_SECRET_KEY>"""
+    if not is_authorized(request.headers.get('Authorization')):
+        return jsonify({"error": "Unauthorized"}), 401
+    return Response(metrics.render(), content_type=metrics.CONTENT_TYPE)
+
 DASHBOARD_HTML = """
 <!DOCTYPE html>
 <html lang="zh-CN">
@@ -131,8 +462,13 @@ DASHBOARD_HTML = """
         tr:hover { background-color: #f1f1f1; }
         .btn-unban { background-color: #dc3545; color: white; border: none; padding: 8px 12px; border-radius: 4px; cursor: pointer; transition: background-color 0.2s; }
         .btn-unban:hover { background-color: #c82333; }
+        .btn-more { margin-top: 15px; background-color: #6c757d; color: white; border: none; padding: 8px 16px; border-radius: 4px; cursor: pointer; }
+        .btn-more:hover { background-color: #5a6268; }
+        .export { font-size: 14px; font-weight: normal; margin-left: 10px; color: #007bff; }
         .message { padding: 15px; border-radius: 5px; margin-bottom: 15px; }
         .message.error { background-color: #f8d7da; color: #721c24; border: 1px solid #f5c6cb; }
+        .search-box { width: 100%; box-sizing: border-box; padding: 10px 12px; font-size: 16px; border: 1px solid #ccc; border-radius: 6px; }
+        .fuzzy { color: #6c757d; font-size: 12px; }
     </style>
 </head>
 <body>
@@ -145,7 +481,24 @@ DASHBOARD_HTML = """
         <div class="stats" id="stats-section">
         </div>
 
-        <h2>⛔ 封禁用户列表</h2>
+        <h2>🔎 用户搜索</h2>
+        <input id="search-input" class="search-box" type="search" placeholder="输入 username 或用户 ID" autocomplete="off">
+        <table id="search-table" style="display:none;">
+            <thead>
+                <tr>
+                    <th>用户 ID</th>
+                    <th>Username</th>
+                    <th>净分 (推荐 / 拉黑)</th>
+                    <th>状态</th>
+                </tr>
+            </thead>
+            <tbody>
+            </tbody>
+        </table>
+
+        <h2>⛔ 封禁用户列表
+            <a class="export" href="/api/banned/export?format=csv&key={{ WEB_SECRET_KEY }}">导出 CSV</a>
+        </h2>
         <table id="banned-table">
             <thead>
                 <tr>
@@ -158,25 +511,32 @@ DASHBOARD_HTML = """
             <tbody>
             </tbody>
         </table>
+        <button id="banned-more" class="btn-more" style="display:none;" onclick="loadBannedUsers(bannedCursor)">加载更多</button>
 
-        <h2>⚙️ 群组设置列表</h2>
+        <h2>⚙️ 群组设置列表
+            <a class="export" href="/api/chat_settings/export?format=csv&key={{ WEB_SECRET_KEY }}">导出 CSV</a>
+        </h2>
         <table id="chat-settings-table">
             <thead>
                 <tr>
                     <th>群 ID</th>
                     <th>入群投票门槛 (天)</th>
                     <th>强制关注频道 ID</th>
+                    <th>近期信誉半衰期</th>
                 </tr>
             </thead>
             <tbody>
             </tbody>
         </table>
+        <button id="settings-more" class="btn-more" style="display:none;" onclick="loadChatSettings(settingsCursor)">加载更多</button>
 
     </div>
 
     <script>
         const API_URL = window.location.origin + '/api';
         const AUTH_HEADER = '{{ WEB_SECRET_KEY }}';
+        const PAGE_SIZE = 50;
+        const DASHBOARD_POLL_MS = 30000;
 
         function getAuthHeaders() {
             return {
@@ -190,56 +550,90 @@ DASHBOARD_HTML = """
             document.getElementById('auth-error').style.display = 'block';
         }
 
-        async function loadStats() {
+        // 首屏数据来自一次 /api/dashboard 请求 (服务端缓存)；之后定时带 If-None-Match 轮询，没有变化时服务端返回 304。
+        // 用户已经“加载更多”的列表不再被轮询结果覆盖
+        let dashboardEtag = null;
+        let bannedPaged = false;
+        let settingsPaged = false;
+
+        async function loadDashboard() {
             try {
-                const response = await fetch(API_URL + '/stats', { headers: getAuthHeaders() });
+                const headers = getAuthHeaders();
+                if (dashboardEtag) headers['If-None-Match'] = dashboardEtag;
+                const response = await fetch(API_URL + '/dashboard', { headers: headers, cache: 'no-store' });
                 if (response.status === 401) throw new Error("Unauthorized");
+                if (response.status === 304) return;
+                dashboardEtag = response.headers.get('ETag');
                 const data = await response.json();
-                
-                const statsHtml = `
-                    <div class="stat-card"><h3>总用户数</h3><p>${data.total_users.toLocaleString()}</p></div>
-                    <div class="stat-card"><h3>总投票数</h3><p>${data.total_votes.toLocaleString()}</p></div>
-                `;
-                document.getElementById('stats-section').innerHTML = statsHtml;
+
+                renderStats(data.stats);
+                if (!bannedPaged) renderBannedPage(data.banned, false);
+                if (!settingsPaged) renderChatSettingsPage(data.chat_settings, false);
             } catch (error) {
                 handleError(error);
             }
         }
 
-        async function loadBannedUsers() {
+        function renderStats(data) {
+            const statsHtml = `
+                <div class="stat-card"><h3>总用户数</h3><p>${data.total_users.toLocaleString()}</p></div>
+                <div class="stat-card"><h3>总投票数</h3><p>${data.total_votes.toLocaleString()}</p></div>
+            `;
+            document.getElementById('stats-section').innerHTML = statsHtml;
+        }
+
+        let bannedCursor = null;
+        let settingsCursor = null;
+
+        // 分页加载：不带 cursor 时从第一页重新开始，否则追加下一页
+        async function loadBannedUsers(cursor = null) {
             const tableBody = document.getElementById('banned-table').getElementsByTagName('tbody')[0];
-            tableBody.innerHTML = '<tr><td colspan="4">加载中...</td></tr>';
+            const moreBtn = document.getElementById('banned-more');
+            if (!cursor) tableBody.innerHTML = '<tr><td colspan="4">加载中...</td></tr>';
+            moreBtn.disabled = true;
             
             try {
-                const response = await fetch(API_URL + '/banned', { headers: getAuthHeaders() });
+                let url = API_URL + '/banned?limit=' + PAGE_SIZE;
+                if (cursor) url += '&cursor=' + encodeURIComponent(cursor);
+                const response = await fetch(url, { headers: getAuthHeaders() });
                 if (response.status === 401) throw new Error("Unauthorized");
-                const users = await response.json();
-
-                tableBody.innerHTML = '';
-                if (users.length === 0) {
-                    tableBody.innerHTML = '<tr><td colspan="4">当前没有被封禁的用户。</td></tr>';
-                    return;
-                }
-
-                users.forEach(user => {
-                    const row = tableBody.insertRow();
-                    row.insertCell().textContent = user.user_id;
-                    row.insertCell().textContent = user.username || 'N/A';
-                    row.insertCell().textContent = user.time ? new Date(user.time).toLocaleString() : '未知';
-                    
-                    const actionCell = row.insertCell();
-                    const unbanBtn = document.createElement('button');
-                    unbanBtn.className = 'btn-unban';
-                    unbanBtn.textContent = '解禁';
-                    unbanBtn.onclick = () => unbanUser(user.user_id, unbanBtn);
-                    actionCell.appendChild(unbanBtn);
-                });
+                renderBannedPage(await response.json(), !!cursor);
+                bannedPaged = !!cursor;
             } catch (error) {
                 handleError(error);
-                tableBody.innerHTML = '<tr><td colspan="4">加载失败。</td></tr>';
+                if (!cursor) tableBody.innerHTML = '<tr><td colspan="4">加载失败。</td></tr>';
+            } finally {
+                moreBtn.disabled = false;
             }
         }
 
+        function renderBannedPage(page, append) {
+            const tableBody = document.getElementById('banned-table').getElementsByTagName('tbody')[0];
+            const users = page.items;
+
+            if (!append) tableBody.innerHTML = '';
+            if (!append && users.length === 0) {
+                tableBody.innerHTML = '<tr><td colspan="4">当前没有被封禁的用户。</td></tr>';
+            }
+
+            users.forEach(user => {
+                const row = tableBody.insertRow();
+                row.insertCell().textContent = user.user_id;
+                row.insertCell().textContent = user.username || 'N/A';
+                row.insertCell().textContent = user.time ? new Date(user.time).toLocaleString() : '未知';
+                
+                const actionCell = row.insertCell();
+                const unbanBtn = document.createElement('button');
+                unbanBtn.className = 'btn-unban';
+                unbanBtn.textContent = '解禁';
+                unbanBtn.onclick = () => unbanUser(user.user_id, unbanBtn);
+                actionCell.appendChild(unbanBtn);
+            });
+
+            bannedCursor = page.next_cursor;
+            document.getElementById('banned-more').style.display = bannedCursor ? 'inline-block' : 'none';
+        }
+
         async function unbanUser(userId, button) {
             if (!confirm(`确定要解除对用户 ID: ${userId} 的封禁吗？`)) return;
 
@@ -269,61 +663,127 @@ DASHBOARD_HTML = """
             }
         }
 
-        async function loadChatSettings() {
+        async function loadChatSettings(cursor = null) {
             const tableBody = document.getElementById('chat-settings-table').getElementsByTagName('tbody')[0];
-            tableBody.innerHTML = '<tr><td colspan="3">加载中...</td></tr>';
+            const moreBtn = document.getElementById('settings-more');
+            if (!cursor) tableBody.innerHTML = '<tr><td colspan="4">加载中...</td></tr>';
+            moreBtn.disabled = true;
             
             try {
-                const response = await fetch(API_URL + '/chat_settings', { headers: getAuthHeaders() });
+                let url = API_URL + '/chat_settings?limit=' + PAGE_SIZE;
+                if (cursor) url += '&cursor=' + encodeURIComponent(cursor);
+                const response = await fetch(url, { headers: getAuthHeaders() });
+                if (response.status === 401) throw new Error("Unauthorized");
+                renderChatSettingsPage(await response.json(), !!cursor);
+                settingsPaged = !!cursor;
+            } catch (error) {
+                handleError(error);
+                if (!cursor) tableBody.innerHTML = '<tr><td colspan="4">加载失败。</td></tr>';
+            } finally {
+                moreBtn.disabled = false;
+            }
+        }
+
+        function renderChatSettingsPage(page, append) {
+            const tableBody = document.getElementById('chat-settings-table').getElementsByTagName('tbody')[0];
+            const settings = page.items;
+
+            if (!append) tableBody.innerHTML = '';
+            if (!append && settings.length === 0) {
+                tableBody.innerHTML = '<tr><td colspan="4">当前没有群组设置记录。</td></tr>';
+            }
+
+            settings.forEach(setting => {
+                const row = tableBody.insertRow();
+                row.insertCell().textContent = setting.chat_id;
+                row.insertCell().textContent = setting.min_join_days + ' 天';
+                row.insertCell().textContent = setting.force_channel_id === 0 ? '未设置' : setting.force_channel_id;
+                row.insertCell().textContent = setting.decay_half_life_days ? setting.decay_half_life_days + ' 天' : '未开启';
+            });
+
+            settingsCursor = page.next_cursor;
+            document.getElementById('settings-more').style.display = settingsCursor ? 'inline-block' : 'none';
+        }
+
+        // 输入停顿 250ms 后搜索；新的输入会取消尚未返回的请求，避免旧结果覆盖新结果
+        let searchTimer = null;
+        let searchController = null;
+
+        function onSearchInput() {
+            clearTimeout(searchTimer);
+            searchTimer = setTimeout(searchUsers, 250);
+        }
+
+        async function searchUsers() {
+            const q = document.getElementById('search-input').value.trim();
+            const table = document.getElementById('search-table');
+            const tableBody = table.getElementsByTagName('tbody')[0];
+            if (searchController) searchController.abort();
+            if (!q) { table.style.display = 'none'; return; }
+            searchController = new AbortController();
+
+            try {
+                const response = await fetch(API_URL + '/search?limit=20&q=' + encodeURIComponent(q),
+                                             { headers: getAuthHeaders(), signal: searchController.signal });
                 if (response.status === 401) throw new Error("Unauthorized");
-                const settings = await response.json();
+                const page = await response.json();
 
                 tableBody.innerHTML = '';
-                if (settings.length === 0) {
-                    tableBody.innerHTML = '<tr><td colspan="3">当前没有群组设置记录。</td></tr>';
-                    return;
+                if (page.items.length === 0) {
+                    tableBody.innerHTML = '<tr><td colspan="4">没有匹配的用户。</td></tr>';
                 }
-
-                settings.forEach(setting => {
+                page.items.forEach(user => {
                     const row = tableBody.insertRow();
-                    row.insertCell().textContent = setting.chat_id;
-                    row.insertCell().textContent = setting.min_join_days + ' 天';
-                    row.insertCell().textContent = setting.force_channel_id === 0 ? '未设置' : setting.force_channel_id;
+                    row.insertCell().textContent = user.user_id;
+                    const nameCell = row.insertCell();
+                    nameCell.textContent = user.username ? '@' + user.username : 'N/A';
+                    if (user.match === 'fuzzy') {
+                        const tag = document.createElement('span');
+                        tag.className = 'fuzzy';
+                        tag.textContent = ' (相似)';
+                        nameCell.appendChild(tag);
+                    }
+                    row.insertCell().textContent = `${user.net > 0 ? '+' : ''}${user.net} (${user.rec} / ${user.black})`;
+                    row.insertCell().textContent = user.banned ? '已封禁' : '正常';
                 });
+                table.style.display = '';
             } catch (error) {
-                handleError(error);
-                tableBody.innerHTML = '<tr><td colspan="3">加载失败。</td></tr>';
+                if (error.name !== 'AbortError') handleError(error);
             }
         }
 
         document.addEventListener('DOMContentLoaded', () => {
-            loadStats();
-            loadBannedUsers();
-            loadChatSettings();
+            document.getElementById('search-input').addEventListener('input', onSearchInput);
+            loadDashboard();
+            setInterval(loadDashboard, DASHBOARD_POLL_MS);
         });
     </script>
 </body>
 </html>
 """
 
+# 页面内容只取决于密钥，启动时生成一次 (与模板渲染相同的 HTML 转义)，之后每次请求直接返回同一份字节
+DASHBOARD_PAGE = DASHBOARD_HTML.replace("{{ WEB_SECRET_KEY }}", str(escape(WEB_SECRET_KEY))).encode()
+DASHBOARD_PAGE_ETAG = make_etag(DASHBOARD_PAGE)
+
 @app.route('/', methods=['GET'])
-def dashboard():
+async def dashboard():
     """管理面板主页"""
     auth_header = request.headers.get('Authorization')
     url_key = request.args.get('key')
     
     # 在处理请求时检查数据库连接状态
-    if not db_pool:
+    if not database.db_pool:
         try:
             # 尝试初始化数据库连接池，如果失败，会抛出异常
-            sync_call(asyncio.sleep(0.01)) # 强制调用 sync_call 来触发初始化
+            await ensure_db_pool()
         except Exception as e:
             # 如果 Web Worker 连接失败，显示 503 错误
             return f"<h1>Web Worker 数据库初始化失败 (503)</h1><p>Bot 可能仍在尝试连接或配置错误，请检查日志。</p><p>详细错误：{e}</p>", 503
 
     # 认证检查
     if is_authorized(auth_header) or (url_key and url_key == WEB_SECRET_KEY):
-        return render_template_string(DASHBOARD_HTML, WEB_SECRET_KEY=WEB_SECRET_KEY)
+        return conditional_response(DASHBOARD_PAGE, DASHBOARD_PAGE_ETAG, "text/html; charset=utf-8")
         
     # 如果认证失败
     return """
@@ -331,7 +791,3 @@ def dashboard():
     <p>访问被拒绝。请使用正确的密钥（通过 URL 参数 <code>?key=YOUR_KEY</code> 或 Bearer 认证 Header）访问。</p>
     <p>密钥: <code>%s</code></p>
     """ % WEB_SECRET_KEY, 401
-
-
-# --- ASGI 兼容性包装 ---
-app = WsgiToAsgi(app)
\ No newline at end of file
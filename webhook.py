@@ -0,0 +1,177 @@
+import os
+import signal
+import asyncio
+import multiprocessing
+from aiohttp import web
+
+# 带 chat 的更新类型：同一个 chat 的更新总是交给同一个 worker，保证群内顺序
+CHAT_UPDATE_FIELDS = (
+    'message', 'edited_message', 'channel_post', 'edited_channel_post',
+    'chat_member', 'my_chat_member', 'chat_join_request', 'message_reaction',
+)
+USER_UPDATE_FIELDS = ('inline_query', 'chosen_inline_result', 'shipping_query', 'pre_checkout_query')
+
+def on_stop_signal(callback, *args):
+    """收到 SIGTERM / SIGINT (部署重启、Ctrl-C) 时在事件循环中调用 callback，
+    让正常的退出流程 (各层的 finally、写缓冲落盘) 得以执行，而不是直接被杀死"""
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        try:
+            loop.add_signal_handler(sig, callback, *args)
+        except NotImplementedError:
+            pass  # Windows 的事件循环不支持，保持默认行为
+
+def shard_key(update: dict) -> int:
+    """取出更新所属的 chat_id (没有 chat 的按用户)，作为分片依据"""
+    for field in CHAT_UPDATE_FIELDS:
+        if field in update:
+            return update[field]['chat']['id']
+    callback = update.get('callback_query')
+    if callback:
+        message = callback.get('message')
+        return message['chat']['id'] if message else callback['from']['id']
+    for field in USER_UPDATE_FIELDS:
+        if field in update:
+            return update[field]['from']['id']
+    return update.get('update_id', 0)
+
+class ShardedDispatcher:
+    """把更新按 chat_id 分发给 N 个 worker 任务：不同群并行处理，同一个群串行处理"""
+
+    def __init__(self, dp, bot, workers: int, stride: int = 1, queue_size: int = 1000):
+        self.dp = dp
+        self.bot = bot
+        # stride: 多进程时每个进程只收到 key % 进程数 相同的更新，先除掉这部分再分片才能分布均匀
+        self.stride = stride
+        self.queues = [asyncio.Queue(maxsize=queue_size) for _ in range(workers)]
+        self.tasks = []
+
+    def start(self):
+        self.tasks = [asyncio.create_task(self.worker(q)) for q in self.queues]
+
+    async def submit(self, update: dict):
+        # 队列满时在这里等待，HTTP 响应随之变慢，Telegram 会自动放缓推送
+        queue = self.queues[shard_key(update) // self.stride % len(self.queues)]
+        await queue.put(update)
+
+    async def worker(self, queue: asyncio.Queue):
+        while True:
+            update = await queue.get()
+            try:
+                await self.dp.feed_raw_update(self.bot, update)
+            except Exception as e:
+                print(f"Update Handling Error: {e}")
+            finally:
+                queue.task_done()
+
+    async def stop(self):
+        """处理完已接收的更新后停止"""
+        for queue in self.queues:
+            await queue.join()
+        for task in self.tasks:
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+
+class ProcessShards:
+    """多进程模式：每个子进程运行完整的 Bot 实例，按 chat_id 取模分配更新。
+    子进程不是 daemon：退出时由 stop() 通知并等待它们处理完已收到的更新、把写缓冲落盘"""
+
+    def __init__(self, target, processes: int):
+        ctx = multiprocessing.get_context('spawn')
+        self.queues = [ctx.Queue() for _ in range(processes)]
+        # 子进程 startup() 完成后置位，主进程据此判断整体是否就绪
+        self.ready = [ctx.Event() for _ in range(processes)]
+        self.procs = [ctx.Process(target=target, args=(q, processes, i, self.ready[i]))
+                      for i, q in enumerate(self.queues)]
+
+    def start(self):
+        for proc in self.procs:
+            proc.start()
+
+    async def wait_ready(self) -> bool:
+        """等待所有子进程完成初始化；有子进程提前退出时返回 False"""
+        loop = asyncio.get_running_loop()
+        for proc, ready in zip(self.procs, self.ready):
+            while not await loop.run_in_executor(None, ready.wait, 1):
+                if not proc.is_alive():
+                    return False
+        return True
+
+    async def submit(self, update: dict):
+        self.queues[shard_key(update) % len(self.queues)].put_nowait(update)
+
+    async def stop(self, timeout: float = 30):
+        for queue in self.queues:
+            queue.put_nowait(None)
+        loop = asyncio.get_running_loop()
+        for proc in self.procs:
+            await loop.run_in_executor(None, proc.join, timeout)
+            if proc.is_alive():
+                print(f"Shard process {proc.pid} did not exit within {timeout}s, terminating")
+                proc.terminate()
+
+async def consume_process_queue(queue, dp, bot, workers: int, stride: int):
+    """子进程内：从进程队列取更新，再分给本进程的 worker 任务"""
+    sharder = ShardedDispatcher(dp, bot, workers, stride=stride)
+    sharder.start()
+    loop = asyncio.get_running_loop()
+    while True:
+        update = await loop.run_in_executor(None, queue.get)
+        if update is None:
+            break
+        await sharder.submit(update)
+    await sharder.stop()
+
+def build_webhook_app(sharder, path: str, secret: str = None) -> web.Application:
+    async def receive(request: web.Request):
+        if secret and request.headers.get('X-Telegram-Bot-Api-Secret-Token') != secret:
+            return web.Response(status=401)
+        await sharder.submit(await request.json())
+        return web.Response()
+
+    app = web.Application()
+    app.router.add_post(path, receive)
+    return app
+
+async def run_webhook(bot, dp, workers: int, processes: int = 1, process_target=None, on_ready=None):
+    """启动 Webhook 服务器；WEBHOOK_URL 为空时只接收不注册 (本地测试或外部已注册)。
+    多进程模式下所有子进程就绪后调用 on_ready，任一子进程启动失败则整体退出"""
+    path = os.environ.get('WEBHOOK_PATH', '/webhook')
+    secret = os.environ.get('WEBHOOK_SECRET') or None
+    host = os.environ.get('WEBHOOK_HOST', '0.0.0.0')
+    port = int(os.environ.get('WEBHOOK_PORT', '8081'))
+    url = os.environ.get('WEBHOOK_URL')
+
+    if processes > 1:
+        sharder = ProcessShards(process_target, processes)
+    else:
+        sharder = ShardedDispatcher(dp, bot, workers)
+    sharder.start()
+
+    runner = web.AppRunner(build_webhook_app(sharder, path, secret))
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    print(f"Webhook server listening on {host}:{port}{path} ({processes} process(es), {workers} workers each)")
+
+    stop = asyncio.Event()
+    on_stop_signal(stop.set)
+
+    async def announce_ready():
+        if await sharder.wait_ready():
+            on_ready()
+        else:
+            print("FATAL: a shard process exited during startup")
+            stop.set()
+
+    watcher = asyncio.create_task(announce_ready()) if processes > 1 and on_ready else None
+    if url:
+        await bot.set_webhook(url.rstrip('/') + path, secret_token=secret,
+                              allowed_updates=dp.resolve_used_update_types())
+    try:
+        await stop.wait()
+        print("Stop signal received, draining updates...")
+    finally:
+        if watcher:
+            watcher.cancel()
+        await runner.cleanup()
+        await sharder.stop()